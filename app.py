@@ -1,13 +1,52 @@
 import os
+import re
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, jsonify, url_for, abort)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, EditUserForm
-from models import db, connect_db, User, Message
+from models import db, connect_db, User, Message, Likes, Follows
+import deletions
+import fragments
+import http_cache
+import instrumentation
+import pagination
+import passwords
+import search
+import snowflake
+import timeline
+
+# Messages per page on the feed, profile and likes pages.
+MESSAGES_PER_PAGE = 100
+
+# Users per page of the /users directory and follower/following lists.
+USERS_PER_PAGE = 60
+
+# Most users one request to /users/follow may follow.
+MAX_BULK_FOLLOWS = 100
+
+# Largest id an INTEGER column holds.
+MAX_USER_ID = 2 ** 31 - 1
+
+# Messages deleted per statement (and commit) by /messages/delete.
+DELETE_BATCH_SIZE = 100
+
+# Largest id a BIGINT column holds.
+MAX_MESSAGE_ID = 2 ** 63 - 1
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_CACHE_KEY = "curr_user_cache"
+
+# How long (seconds) the session's copy of the current user is trusted.
+CURR_USER_CACHE_TTL = 60
+
+# After confirming their password, users can keep editing their profile
+# for this long (seconds) without entering it again.
+REAUTH_KEY = "reauth_at"
+REAUTH_WINDOW = 300
 
 app = Flask(__name__)
 
@@ -20,30 +59,131 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Password hashing (see passwords.py): bcrypt work factor, size of the
+# hashing process pool (0 hashes inline), how many hashes may be in flight
+# before we answer 429, and how long to wait for one.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PENDING', 16))
+app.config['PASSWORD_HASH_TIMEOUT'] = 10
+
+# How many rendered message rows to keep (see fragments.py).
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+
+# Bearer token a Prometheus scraper must present to read /metrics (see
+# instrumentation.py); unset, /metrics isn't served.
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Run queued account deletions on a thread in each app process (see
+# deletions.py); with this off, use `flask process-deletions`.
+app.config['DELETION_WORKER'] = (
+    os.environ.get('DELETION_WORKER', '1') == '1')
+
+# A fixed worker number for message ids, only for one process per value;
+# unset, each process claims a free one from the database (see
+# snowflake.py).
+if os.environ.get('SNOWFLAKE_WORKER_ID'):
+    app.config['SNOWFLAKE_WORKER_ID'] = int(os.environ['SNOWFLAKE_WORKER_ID'])
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+instrumentation.init_app(app)
+passwords.init_app(app)
+fragments.init_app(app)
+http_cache.init_app(app)
+snowflake.init_app(app, db)
 
 
 ##############################################################################
 # User signup/login/logout
 
 
+class CurrentUser:
+    """The logged-in user, as cached in the session.
+
+    Holds just the fields the nav bar and sidebar need. Any other attribute
+    (relationships, counters, methods) loads the full User on first use, so
+    routes that only render the nav never touch the database for it.
+    """
+
+    FIELDS = ('id', 'username', 'image_url', 'header_image_url')
+
+    def __init__(self, fields, user=None):
+        for name in self.FIELDS:
+            setattr(self, name, fields[name])
+        self._user = user
+
+    @classmethod
+    def from_user(cls, user):
+        return cls({name: getattr(user, name) for name in cls.FIELDS}, user)
+
+    def load(self):
+        """The full ORM User (queried once per request, if at all)."""
+
+        if self._user is None:
+            # the cached copy can outlive the account (see add_user_to_g)
+            self._user = User.get_active_or_404(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    Page views use the session's cached copy of the user while it's fresh,
+    and only query the database when it's missing or older than the TTL.
+    Anything else (posting, liking, following...) always loads the user, so
+    a session can't keep acting for an account deactivated elsewhere, e.g.
+    by delete_user() in another browser.
+    """
 
+    if CURR_USER_KEY not in session:
+        g.user = None
+        return
+
+    cached = session.get(CURR_USER_CACHE_KEY)
+    if (request.method in ('GET', 'HEAD')
+            and cached and cached['id'] == session[CURR_USER_KEY]
+            and time.time() - cached['cached_at'] < CURR_USER_CACHE_TTL):
+        g.user = CurrentUser(cached)
+        return
+
+    user = User.query.get(session[CURR_USER_KEY])
+    if user and not user.deactivated_at:
+        g.user = cache_current_user(user)
     else:
+        do_logout()
         g.user = None
 
 
+def cache_current_user(user):
+    """Store `user`'s lightweight fields in the session; return CurrentUser.
+
+    Call this again whenever those fields change (see profile()).
+    """
+
+    current = CurrentUser.from_user(user)
+    session[CURR_USER_CACHE_KEY] = dict(
+        {name: getattr(current, name) for name in CurrentUser.FIELDS},
+        cached_at=time.time())
+    return current
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    cache_current_user(user)
 
 
 def do_logout():
@@ -52,6 +192,34 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(CURR_USER_CACHE_KEY, None)
+    session.pop(REAUTH_KEY, None)
+
+
+def recently_reauthenticated():
+    """Did the current user confirm their password within REAUTH_WINDOW?"""
+
+    reauth = session.get(REAUTH_KEY)
+    return bool(reauth and reauth['id'] == g.user.id
+                and time.time() - reauth['at'] < REAUTH_WINDOW)
+
+
+def reauthenticate(password):
+    """Confirm the current user's password, remembering success briefly.
+
+    Checks against the hash of the already-loaded g.user, and skips bcrypt
+    entirely if they confirmed within the last REAUTH_WINDOW seconds.
+    """
+
+    if recently_reauthenticated():
+        return True
+
+    if password and g.user.check_password(password):
+        session[REAUTH_KEY] = {'id': g.user.id, 'at': time.time()}
+        return True
+
+    return False
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -104,6 +272,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # authenticate() may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -125,62 +295,208 @@ def logout():
 ##############################################################################
 # General user routes:
 
+def user_cards():
+    """Query for just the columns users/cards.html renders."""
+
+    return (User
+            .query
+            .filter(User.deactivated_at.is_(None))
+            .with_entities(User.id,
+                           User.username,
+                           User.image_url,
+                           User.header_image_url,
+                           User.bio))
+
+
+def follow_cards(endpoint, user_id, owner_col, other_col):
+    """One page of the users on the other side of `user_id`'s follows.
+
+    `owner_col` is the Follows column holding `user_id`, `other_col` the
+    one pointing at the users to list; pages are keyed on `other_col`,
+    which both Follows indexes cover. Returns (users, next_url).
+    """
+
+    cursor = pagination.parse_id_cursor(request.args.get('after'))
+    users = pagination.paginate(
+        pagination
+        .after_id(user_cards()
+                  .join(Follows, other_col == User.id)
+                  .filter(owner_col == user_id),
+                  other_col, cursor)
+        .limit(USERS_PER_PAGE + 1),
+        USERS_PER_PAGE)
+
+    next_url = None
+    if users.next_cursor:
+        next_url = url_for(endpoint, user_id=user_id,
+                           after=users.next_cursor)
+
+    return users, next_url
+
+
 @app.route('/users')
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Without 'q', lists every user in id order, USERS_PER_PAGE at a time;
+    an 'after' param (the last id on the previous page) gets the next page.
+
+    Can take a 'q' param in querystring to search users by username, bio
+    and location (see search.py), and a 'page' param to page through the
+    ranked results.
+
+    With 'format=json' returns the same page as JSON, for infinite scroll.
     """
 
-    search = request.args.get('q')
+    q = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
+    if not q:
+        cursor = pagination.parse_id_cursor(request.args.get('after'))
+        users = pagination.paginate(
+            pagination
+            .after_id(user_cards(), User.id, cursor)
+            .limit(USERS_PER_PAGE + 1),
+            USERS_PER_PAGE)
+        next_args = {'after': users.next_cursor}
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = search.users(q, page=request.args.get('page', 1, type=int))
+        next_args = {'q': q, 'page': users.next_cursor}
+
+    next_url = None
+    if users.next_cursor:
+        next_url = url_for('list_users', **next_args,
+                           format=request.args.get('format'))
+
+    if request.args.get('format') == 'json':
+        fields = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+        return jsonify(
+            users=[{field: getattr(user, field) for field in fields}
+                   for user in users],
+            next=next_url)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, next_url=next_url)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
 
-    user = User.query.get_or_404(user_id)
+    Takes an optional 'before' cursor param to page back through messages.
+    """
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    user = User.get_active_or_404(user_id)
+    cursor = pagination.parse_id_cursor(request.args.get('before'))
+
+    def etag_parts():
+        # the header shows the profile and counters; a new or deleted
+        # message changes the latest one or messages_count
+        latest = (db.session
+                  .query(db.func.max(Message.id))
+                  .filter(Message.user_id == user_id)
+                  .scalar())
+        return (user.id, user.profile_version, user.messages_count,
+                user.following_count, user.followers_count,
+                user.likes_count, latest)
+
+    def render():
+        # snagging messages in order from the database;
+        # user.messages won't be in order by default
+        messages = pagination.paginate(
+            pagination
+            .before_id(Message
+                       .query
+                       .options(db.joinedload(Message.user))
+                       .filter(Message.user_id == user_id),
+                       Message.id, cursor)
+            .limit(MESSAGES_PER_PAGE + 1),
+            MESSAGES_PER_PAGE)
+        return render_template('users/show.html', user=user,
+                               messages=messages)
+
+    return http_cache.conditional(etag_parts, render)
 
 
 @app.route('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following.
+
+    USERS_PER_PAGE at a time, in id order; 'after' pages on.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.get_active_or_404(user_id)
+    users, next_url = follow_cards('show_following', user_id,
+                                   Follows.user_following_id,
+                                   Follows.user_being_followed_id)
+    return render_template('users/following.html', user=user, users=users,
+                           next_url=next_url)
 
 
 @app.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user.
+
+    USERS_PER_PAGE at a time, in id order; 'after' pages on.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.get_active_or_404(user_id)
+    users, next_url = follow_cards('users_followers', user_id,
+                                   Follows.user_being_followed_id,
+                                   Follows.user_following_id)
+    return render_template('users/followers.html', user=user, users=users,
+                           next_url=next_url)
+
+
+def request_ids(name, max_id):
+    """The ids posted in field `name`, or abort(400) if they aren't ids.
+
+    Form posts repeat the field. JSON bodies must be an object whose `name`
+    is a list of integers or digit strings. Every id must fit its column
+    (0 to `max_id`), so a bad one can't reach the database.
+    """
+
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        raw_ids = payload.get(name, []) if isinstance(payload, dict) else None
+        if not isinstance(raw_ids, list):
+            abort(400)
+    else:
+        raw_ids = request.form.getlist(name)
+
+    ids = []
+    for raw_id in raw_ids:
+        if isinstance(raw_id, str) and re.fullmatch(r'[0-9]+', raw_id):
+            raw_id = int(raw_id)
+        if (not isinstance(raw_id, int) or isinstance(raw_id, bool)
+                or not 0 <= raw_id <= max_id):
+            abort(400)
+        ids.append(raw_id)
+
+    return ids
+
+
+def follow_users(user_ids):
+    """Have g.user follow `user_ids`; returns the ids newly followed.
+
+    Counters and timelines are only touched for follows that didn't
+    already exist, so repeating a follow is harmless.
+    """
+
+    added = Follows.follow(g.user.id, user_ids)
+    if added:
+        User.adjust_counts(g.user.id, following_count=len(added))
+        User.adjust_counts(added, followers_count=1)
+        timeline.backfill(g.user.id, added)
+    db.session.commit()
+
+    return added
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -191,9 +507,34 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    # nothing added: already following, or there's no such user
+    if not follow_users([follow_id]):
+        User.get_active_or_404(follow_id)
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@app.route('/users/follow', methods=['POST'])
+def add_follows():
+    """Follow several users at once (e.g. suggestions during onboarding).
+
+    Takes `user_ids` as repeated form fields or a JSON list; at most
+    MAX_BULK_FOLLOWS of them. Unknown and already-followed ids are skipped.
+    JSON requests get back the ids newly followed.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user_ids = request_ids('user_ids', MAX_USER_ID)
+    if len(user_ids) > MAX_BULK_FOLLOWS:
+        abort(400)
+
+    added = follow_users(user_ids)
+
+    if request.is_json:
+        return jsonify(followed=sorted(added))
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -206,9 +547,13 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    if Follows.unfollow(g.user.id, follow_id):
+        User.adjust_counts(g.user.id, following_count=-1)
+        User.adjust_counts(follow_id, followers_count=-1)
+        timeline.unfill(g.user.id, follow_id)
+        db.session.commit()
+    else:
+        User.query.get_or_404(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -224,22 +569,41 @@ def profile():
     form = EditUserForm(obj=g.user)
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        if not reauthenticate(form.password.data):
+            flash("Incorrect password.", "danger")
+            return render_template('users/edit.html', form=form,
+                                   needs_password=True)
 
-        if user:
-            user.username = form.username.data
-            user.email = form.email.data
-            user.image_url = form.image_url.data
-            user.header_image_url = form.header_image_url.data
-            user.bio = form.bio.data
+        try:
+            # one UPDATE for all the fields
+            (User
+             .query
+             .filter(User.id == g.user.id)
+             .update({'username': form.username.data,
+                      'email': form.email.data,
+                      'image_url': form.image_url.data,
+                      'header_image_url': form.header_image_url.data,
+                      'bio': form.bio.data,
+                      'profile_version': User.profile_version + 1},
+                     synchronize_session=False))
             db.session.commit()
 
-            flash("Profile edited successfully", "success")
-            return redirect(f'/users/{g.user.id}')
+        except IntegrityError:
+            db.session.rollback()
+            flash("Username or email already taken", 'danger')
+            return render_template('users/edit.html', form=form,
+                                   needs_password=False)
+
+        # the bulk UPDATE skipped ORM events, so tell search ourselves
+        search.index.invalidate()
+        cache_current_user(g.user.load())
+
+        flash("Profile edited successfully", "success")
+        return redirect(f'/users/{g.user.id}')
 
     else:
-        return render_template('users/edit.html', form=form)
+        return render_template('users/edit.html', form=form,
+                               needs_password=not recently_reauthenticated())
 
 
 @app.route('/users/delete', methods=["POST"])
@@ -252,22 +616,39 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # the user disappears now; their data goes in the background
+    deletions.request_deletion(g.user.id)
     db.session.commit()
+    deletions.wake()
 
     return redirect("/signup")
 
 
 @app.route('/users/<int:user_id>/likes')
 def users_likes(user_id):
-    """ Show messages liked by this user. """
+    """ Show messages liked by this user.
+
+    Takes an optional 'before' cursor param to page back through likes.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    user = User.query.get_or_404(user_id)
-    return render_template("/users/likes.html", user=user)
+    user = User.get_active_or_404(user_id)
+    cursor = pagination.parse_id_cursor(request.args.get('before'))
+
+    messages = pagination.paginate(
+        pagination
+        .before_id(Message
+                   .query
+                   .options(db.joinedload(Message.user))
+                   .join(Likes, Likes.message_id == Message.id)
+                   .filter(Likes.user_id == user_id),
+                   Likes.message_id, cursor)
+        .limit(MESSAGES_PER_PAGE + 1),
+        MESSAGES_PER_PAGE)
+    return render_template("/users/likes.html", user=user, messages=messages)
 
 
 ##############################################################################
@@ -287,8 +668,12 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        # not g.user.messages.append(), which would load all of them
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        User.adjust_counts(g.user.id, messages_count=1)
+        timeline.fan_out(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -300,8 +685,15 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message
+           .query
+           .options(db.joinedload(Message.user))
+           .get_or_404(message_id))
+
+    # a message's text never changes, but its author's profile can
+    return http_cache.conditional(
+        lambda: (msg.id, msg.timestamp, msg.user_id, msg.user.profile_version),
+        lambda: render_template('messages/show.html', message=msg))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -312,17 +704,46 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    if msg in g.user.messages:
-        db.session.delete(msg)
-        db.session.commit()
-    else:
+    deleted = deletions.delete_messages(g.user.id, [message_id])
+    db.session.commit()
+
+    if not deleted:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     return redirect(f"/users/{g.user.id}")
 
 
+@app.route('/messages/delete', methods=["POST"])
+def messages_destroy_many():
+    """Delete many of the current user's messages.
+
+    Takes `message_ids` as repeated form fields or a JSON list, and deletes
+    them DELETE_BATCH_SIZE at a time, committing after each batch. Ids that
+    aren't the user's are skipped. JSON requests get back the ids deleted,
+    as strings.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    message_ids = sorted(set(request_ids('message_ids', MAX_MESSAGE_ID)))
+
+    deleted = []
+    for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        deleted += deletions.delete_messages(
+            g.user.id, message_ids[start:start + DELETE_BATCH_SIZE])
+        db.session.commit()
+
+    if request.is_json:
+        # snowflakes don't fit in a JavaScript number
+        return jsonify(deleted=[str(message_id) for message_id in deleted])
+
+    flash(f"Deleted {len(deleted)} messages.", "success")
+    return redirect(f"/users/{g.user.id}")
+
+
 @app.route('/messages/<int:msg_id>/like', methods=["POST"])
 def toggle_like(msg_id):
     """ Add or remove like for the currently-logged-in user. """
@@ -331,12 +752,8 @@ def toggle_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    liked_msg = Message.query.get_or_404(msg_id)
-
-    if liked_msg in g.user.likes:
-        g.user.likes.remove(liked_msg)
-    else:
-        g.user.likes.append(liked_msg)
+    if Likes.toggle(g.user.id, msg_id) is None:
+        abort(404)
 
     db.session.commit()
 
@@ -352,22 +769,18 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, read from
+      the user's materialized timeline (see timeline.py); a 'before'
+      cursor param pages further back
     """
 
     if g.user:
-        people = []
-        for person in g.user.following:
-            people.append(person.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(people))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        likes = []
-        for like in g.user.likes:
-            likes.append(like.id)
+        cursor = pagination.parse_id_cursor(request.args.get('before'))
+        messages = pagination.paginate(
+            timeline.feed(g.user.id, limit=MESSAGES_PER_PAGE + 1,
+                          before=cursor),
+            MESSAGES_PER_PAGE)
+        likes = g.user.liked_ids(msg.id for msg in messages)
         return render_template('home.html', messages=messages, likes=likes)
 
     else:
@@ -375,18 +788,31 @@ def homepage():
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Maintenance commands
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Recompute every user's home timeline from follows and messages."""
+
+    count = timeline.rebuild()
+    db.session.commit()
+    print(f"Wrote {count} timeline entries.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute users' and messages' counters to repair drift."""
+
+    users = User.reconcile_counts()
+    messages = Message.reconcile_counts()
+    db.session.commit()
+    print(f"Repaired counters for {users} users and {messages} messages.")
+
+
+@app.cli.command('process-deletions')
+def process_deletions():
+    """Run queued account deletions to completion."""
+
+    for job in deletions.run_pending():
+        print(f"Deleted user {job.user_id} ({job.rows_deleted} rows).")
@@ -0,0 +1,8 @@
+"""Benchmarks for Warbler.
+
+Run these from the repo root as modules, e.g.:
+
+    python -m benchmarks.timeline --users 20000
+
+They use an in-memory SQLite database unless DATABASE_URL is set.
+"""
@@ -0,0 +1,86 @@
+"""Shared helpers for the benchmark scripts."""
+
+import os
+import random
+import time
+from bisect import bisect_left
+from itertools import accumulate
+
+
+def load_app(database_url=None, reset=True):
+    """Import the Flask app against a benchmark database.
+
+    Like the tests, this must set DATABASE_URL before app.py is imported.
+    Unless `reset` is false, the schema is dropped and recreated.
+    """
+
+    os.environ['DATABASE_URL'] = (
+        database_url or os.environ.get('DATABASE_URL') or 'sqlite://')
+
+    from app import app
+    from models import db
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    if reset:
+        db.drop_all()
+        db.create_all()
+    return app
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of `samples` (0 < pct <= 100)."""
+
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    rank = max(0, int(round(pct / 100 * len(ordered))) - 1)
+    return ordered[rank]
+
+
+def summarize(samples):
+    """Count and p50/p95/p99 (in milliseconds) for durations in seconds."""
+
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+    }
+
+
+class Timer:
+    """Context manager that appends the elapsed time to a list."""
+
+    def __init__(self, samples):
+        self.samples = samples
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.samples.append(time.perf_counter() - self.start)
+
+
+class PowerLaw:
+    """Draw ids 1..n with probability following a Zipf-like power law."""
+
+    def __init__(self, n, exponent=1.1, rng=random):
+        self.rng = rng
+        self.ids = list(range(1, n + 1))
+        rng.shuffle(self.ids)
+        self.cum_weights = list(accumulate(1 / rank ** exponent
+                                           for rank in range(1, n + 1)))
+
+    def draw(self):
+        point = self.rng.random() * self.cum_weights[-1]
+        return self.ids[bisect_left(self.cum_weights, point)]
+
+    def sample(self, k):
+        """`k` distinct ids (k must be well below n)."""
+
+        picked = set()
+        while len(picked) < k:
+            picked.add(self.draw())
+        return picked
@@ -0,0 +1,281 @@
+"""Micro-benchmarks for Warbler's model and view hot paths.
+
+Seeds a power-law dataset at each requested size (counted in messages),
+then times each case over a fixed number of iterations:
+
+- is_following: User.is_following() between random users
+- authenticate: User.authenticate() with the right password (bcrypt)
+- homepage: GET / for a logged-in user (feed assembly)
+- users_show: GET /users/<id> for a random profile
+- list_users_search: GET /users?q=<fragment>
+- toggle_like: POST /messages/<id>/like, liking and unliking
+
+Results (p50/p95/p99 and SQL queries per call) are printed as JSON and can
+be saved with --output to track over time. With --baseline, any case whose
+p50 grew by more than --threshold against the saved results makes the run
+exit non-zero.
+
+Example:
+
+    python -m benchmarks.micro --sizes 1k,100k --output micro.json
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.micro \\
+        --sizes 1k,100k,1m --baseline micro.json --threshold 0.2
+"""
+
+import argparse
+import json
+import random
+import sys
+from datetime import datetime, timedelta
+
+from benchmarks.common import load_app, summarize, Timer, PowerLaw
+
+BATCH_SIZE = 20000
+
+CASES = {}
+
+
+def case(name, iterations=None):
+    """Register a benchmark case.
+
+    A case takes the Fixture and returns a function to time, called once
+    per iteration. `iterations` caps --iterations for slow cases.
+    """
+
+    def register(setup):
+        CASES[name] = (setup, iterations)
+        return setup
+    return register
+
+
+def parse_size(raw):
+    """'1k' -> 1000, '1m' -> 1000000."""
+
+    raw = raw.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(raw[-1:], 1)
+    return int(float(raw.rstrip('km')) * scale)
+
+
+class Fixture:
+    """A seeded database plus a test client logged in as a typical user."""
+
+    PASSWORD = "password"
+
+    def __init__(self, app, messages, rng):
+        from app import CURR_USER_KEY
+        from models import db, Follows, Message, User
+        from passwords import hasher
+        import search
+        import timeline
+
+        self.app = app
+        self.rng = rng
+        self.users = max(100, messages // 10)
+        self.messages = messages
+
+        db.drop_all()
+        db.create_all()
+
+        hashed = hasher.hash(self.PASSWORD)
+        for start in range(0, self.users, BATCH_SIZE):
+            db.session.execute(User.__table__.insert(), [
+                dict(email=f"user{i}@bench.test", username=f"user{i}",
+                     password=hashed, bio=f"bench user number {i}")
+                for i in range(start + 1,
+                               min(start + BATCH_SIZE, self.users) + 1)
+            ])
+
+        popularity = PowerLaw(self.users, 1.1, rng)
+        follows = []
+        for follower in range(1, self.users + 1):
+            degree = min(self.users // 2, int(rng.paretovariate(1.5) * 10 / 3))
+            follows.extend(dict(user_being_followed_id=followed,
+                                user_following_id=follower)
+                           for followed in popularity.sample(degree)
+                           if followed != follower)
+            if len(follows) >= BATCH_SIZE:
+                db.session.execute(Follows.__table__.insert(), follows)
+                follows = []
+        if follows:
+            db.session.execute(Follows.__table__.insert(), follows)
+
+        activity = PowerLaw(self.users, 1.1, rng)
+        start = datetime.utcnow() - timedelta(days=365)
+        for offset in range(0, messages, BATCH_SIZE):
+            db.session.execute(Message.__table__.insert(), [
+                dict(text=f"bench warble {i}", user_id=activity.draw(),
+                     timestamp=start + timedelta(seconds=i * 10))
+                for i in range(offset, min(offset + BATCH_SIZE, messages))
+            ])
+        db.session.commit()
+
+        User.reconcile_counts()
+        timeline.rebuild()
+        search.index.invalidate()
+        db.session.commit()
+
+        # Read as the user at the median of the follow graph
+        self.reader_id = (db.session
+                          .query(User.id)
+                          .order_by(User.following_count, User.id)
+                          .offset(self.users // 2)
+                          .limit(1)
+                          .scalar())
+        self.other_message_ids = [
+            id for (id,) in (db.session
+                             .query(Message.id)
+                             .filter(Message.user_id != self.reader_id)
+                             .limit(100))
+        ]
+        db.session.remove()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def random_user_id(self):
+        return self.rng.randint(1, self.users)
+
+
+@case('is_following')
+def is_following(fixture):
+    from models import User
+
+    users = User.query.filter(User.id.in_(
+        [fixture.random_user_id() for _ in range(50)])).all()
+
+    def run():
+        first, second = fixture.rng.sample(users, 2)
+        first.is_following(second)
+    return run
+
+
+@case('authenticate', iterations=10)
+def authenticate(fixture):
+    from models import User
+
+    def run():
+        username = f"user{fixture.random_user_id()}"
+        assert User.authenticate(username, Fixture.PASSWORD)
+    return run
+
+
+@case('homepage')
+def homepage(fixture):
+    def run():
+        fixture.client.get("/")
+    return run
+
+
+@case('users_show')
+def users_show(fixture):
+    def run():
+        fixture.client.get(f"/users/{fixture.random_user_id()}")
+    return run
+
+
+@case('list_users_search')
+def list_users_search(fixture):
+    def run():
+        fixture.client.get(f"/users?q=user{fixture.rng.randint(1, 999)}")
+    return run
+
+
+@case('toggle_like')
+def toggle_like(fixture):
+    def run():
+        msg_id = fixture.rng.choice(fixture.other_message_ids)
+        fixture.client.post(f"/messages/{msg_id}/like")
+        fixture.client.post(f"/messages/{msg_id}/like")
+    return run
+
+
+def measure(fixture, name, iterations, warmup=2):
+    """Time one case; returns its summary plus queries per call."""
+
+    from instrumentation import count_queries
+    from models import db
+
+    setup, cap = CASES[name]
+    run = setup(fixture)
+    if cap:
+        iterations = min(iterations, cap)
+
+    for _ in range(warmup):
+        run()
+
+    with count_queries() as queries:
+        run()
+
+    samples = []
+    for _ in range(iterations):
+        with Timer(samples):
+            run()
+        db.session.remove()
+
+    stats = summarize(samples)
+    stats['queries'] = queries.count
+    return stats
+
+
+def regressions(baseline, results, threshold):
+    """Cases whose p50 grew by more than `threshold` over the baseline."""
+
+    found = []
+    for size, cases in results.items():
+        for name, stats in cases.items():
+            before = baseline.get(size, {}).get(name)
+            if not before or not before['p50_ms']:
+                continue
+
+            change = (stats['p50_ms'] - before['p50_ms']) / before['p50_ms']
+            if change > threshold:
+                found.append(f"{size} {name}: p50 {before['p50_ms']}ms -> "
+                             f"{stats['p50_ms']}ms ({change:+.0%})")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1k,100k,1m',
+                        help="dataset sizes, in messages")
+    parser.add_argument('--cases', default=','.join(CASES))
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url')
+    parser.add_argument('--output', help="write the results here as well")
+    parser.add_argument('--baseline', help="results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed p50 growth, as a fraction")
+    args = parser.parse_args()
+
+    app = load_app(args.database_url)
+    from models import db
+
+    names = [name.strip() for name in args.cases.split(',')]
+    results = {}
+    for size in args.sizes.split(','):
+        fixture = Fixture(app, parse_size(size), random.Random(args.seed))
+        results[size] = {name: measure(fixture, name, args.iterations)
+                         for name in names}
+
+    report = {'dialect': db.engine.dialect.name, 'results': results}
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+        found = regressions(baseline, results, args.threshold)
+        if found:
+            print(f"\n{len(found)} regression(s):", file=sys.stderr)
+            print("\n".join(found), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,350 @@
+"""Replay a recorded request log against Warbler and report per-route stats.
+
+The log is JSON lines, one request each:
+
+    {"method": "GET", "path": "/users/5?before=...", "user_id": 12}
+    {"method": "POST", "path": "/messages/new", "user_id": 12,
+     "form": {"text": "hello"}}
+
+`user_id` (optional) replays the request as that user: each simulated user
+gets a signed session cookie, and keeps whatever session the app hands back,
+as a browser would. `form` is sent as the POST body. Lines written by the
+warbler.requests log (see instrumentation.py) can be replayed as they are.
+
+Requests go to the app in this process, either through Flask's test client
+or over HTTP to a local threaded WSGI server, from --concurrency threads.
+The app runs against DATABASE_URL as it is (load it with seed.py first).
+
+For each route the report gives throughput, p50/p95/p99 latency, SQL
+queries per request and the error (5xx) rate. `compare` diffs two reports
+and exits non-zero if any route got worse by more than --threshold.
+
+Example:
+
+    DATABASE_URL=postgresql:///warbler python -m benchmarks.replay run \\
+        access.jsonl --concurrency 8 --server --output after.json
+    python -m benchmarks.replay compare before.json after.json
+"""
+
+import argparse
+import http.client
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from socketserver import ThreadingMixIn
+from urllib.parse import urlencode, urlsplit
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+from benchmarks.common import load_app, summarize
+
+QUERIES_HEADER = 'X-Replay-Queries'
+
+# Metrics where a bigger number in the new report is a regression.
+COMPARED = ['p50_ms', 'p95_ms', 'p99_ms', 'queries_mean', 'error_rate']
+
+
+def read_log(path):
+    """Requests from a JSONL log; blank lines are skipped."""
+
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def instrument(app):
+    """Report each request's SQL query count in a response header.
+
+    Must be called before the app handles its first request.
+    """
+
+    from flask import g
+
+    @app.after_request
+    def add_query_count(response):
+        metrics = g.get('metrics')
+        if metrics is not None:
+            response.headers[QUERIES_HEADER] = str(metrics.queries)
+        return response
+
+
+class Sessions:
+    """The current session cookie of every simulated user."""
+
+    def __init__(self, app):
+        from app import CURR_USER_KEY
+
+        self.lock = threading.Lock()
+        self.cookie_name = app.session_cookie_name
+        self.serializer = app.session_interface.get_signing_serializer(app)
+        self.key = CURR_USER_KEY
+        self.cookies = {}
+
+    def cookie(self, user_id):
+        """Cookie header for `user_id`, logging them in on first use."""
+
+        if user_id is None:
+            return None
+
+        with self.lock:
+            if user_id not in self.cookies:
+                self.cookies[user_id] = self.serializer.dumps(
+                    {self.key: user_id})
+            return f"{self.cookie_name}={self.cookies[user_id]}"
+
+    def update(self, user_id, set_cookie_headers):
+        """Keep the session the app sent back, if any."""
+
+        if user_id is None:
+            return
+
+        for header in set_cookie_headers:
+            morsel = SimpleCookie(header).get(self.cookie_name)
+            if morsel is not None:
+                with self.lock:
+                    self.cookies[user_id] = morsel.value
+
+
+class TestClientTarget:
+    """Sends requests through a Flask test client (one per thread)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def send(self, method, path, headers, body):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client(use_cookies=False)
+
+        response = self.local.client.open(
+            path, method=method, headers=headers, data=body,
+            content_type='application/x-www-form-urlencoded')
+        response.close()
+        return (response.status_code, response.headers.get(QUERIES_HEADER),
+                response.headers.getlist('Set-Cookie'))
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ServerTarget:
+    """Sends requests over HTTP to the app served on a local port."""
+
+    def __init__(self, app, host='127.0.0.1', port=0):
+        self.server = make_server(host, port, app,
+                                  server_class=_ThreadingWSGIServer,
+                                  handler_class=_QuietHandler)
+        self.host, self.port = self.server.server_address[:2]
+        self.local = threading.local()
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def send(self, method, path, headers, body):
+        if not hasattr(self.local, 'conn'):
+            self.local.conn = http.client.HTTPConnection(self.host, self.port)
+
+        headers = dict(headers)
+        if body:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        conn = self.local.conn
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            raise
+
+        return (response.status, response.getheader(QUERIES_HEADER),
+                [value for name, value in response.getheaders()
+                 if name.lower() == 'set-cookie'])
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def route_for(app, method, path):
+    """The endpoint `path` maps to, for grouping results."""
+
+    adapter = app.url_map.bind('localhost')
+    try:
+        endpoint, _ = adapter.match(urlsplit(path).path, method)
+        return endpoint
+    except Exception:
+        return 'unmatched'
+
+
+def replay(app, entries, target, concurrency=1):
+    """Send every entry to `target`; returns (results, elapsed seconds).
+
+    Each result is a dict of route, status, seconds and queries. A request
+    that fails outright is recorded with status 0.
+    """
+
+    sessions = Sessions(app)
+
+    def run(entry):
+        method = entry.get('method', 'GET').upper()
+        path = entry['path']
+        user_id = entry.get('user_id')
+        form = entry.get('form')
+
+        headers = {}
+        cookie = sessions.cookie(user_id)
+        if cookie:
+            headers['Cookie'] = cookie
+        body = urlencode(form) if form else None
+
+        start = time.perf_counter()
+        try:
+            status, queries, set_cookies = target.send(method, path,
+                                                       headers, body)
+        except Exception:
+            status, queries, set_cookies = 0, None, []
+        seconds = time.perf_counter() - start
+
+        sessions.update(user_id, set_cookies)
+        return {
+            'route': f"{method} {route_for(app, method, path)}",
+            'status': status,
+            'seconds': seconds,
+            'queries': int(queries) if queries is not None else None,
+        }
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run, entries))
+
+    return results, time.perf_counter() - start
+
+
+def report(results, elapsed):
+    """Aggregate replay results per route (and overall)."""
+
+    by_route = defaultdict(list)
+    for result in results:
+        by_route[result['route']].append(result)
+        by_route['ALL'].append(result)
+
+    routes = {}
+    for route, rows in sorted(by_route.items()):
+        queries = [row['queries'] for row in rows
+                   if row['queries'] is not None]
+        errors = sum(1 for row in rows
+                     if row['status'] == 0 or row['status'] >= 500)
+
+        stats = summarize([row['seconds'] for row in rows])
+        stats.update({
+            'throughput_rps': round(len(rows) / max(elapsed, 1e-9), 2),
+            'queries_mean': (round(sum(queries) / len(queries), 2)
+                             if queries else None),
+            'queries_max': max(queries) if queries else None,
+            'error_rate': round(errors / len(rows), 4),
+        })
+        routes[route] = stats
+
+    return {'requests': len(results), 'elapsed_s': round(elapsed, 3),
+            'routes': routes}
+
+
+def compare(old, new, threshold=0.1):
+    """Diff two reports route by route.
+
+    Returns (lines, regressions): a line per compared metric, and the lines
+    for metrics that grew by more than `threshold` (a fraction). Error rates
+    are compared in absolute terms.
+    """
+
+    lines = []
+    regressions = []
+
+    for route in sorted(set(old['routes']) & set(new['routes'])):
+        before, after = old['routes'][route], new['routes'][route]
+
+        for metric in COMPARED:
+            a, b = before.get(metric), after.get(metric)
+            if a is None or b is None:
+                continue
+
+            if metric == 'error_rate':
+                change = b - a
+            else:
+                change = (b - a) / a if a else (1.0 if b else 0.0)
+
+            line = f"{route:40} {metric:14} {a:>10} -> {b:<10} {change:+.1%}"
+            lines.append(line)
+            if change > threshold:
+                regressions.append(line)
+
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help="replay a request log")
+    run_parser.add_argument('log')
+    run_parser.add_argument('--concurrency', type=int, default=1)
+    run_parser.add_argument('--repeat', type=int, default=1,
+                            help="replay the log this many times")
+    run_parser.add_argument('--server', action='store_true',
+                            help="go over HTTP to a local WSGI server")
+    run_parser.add_argument('--database-url')
+    run_parser.add_argument('--output', help="write the report here as well")
+
+    compare_parser = commands.add_parser('compare',
+                                         help="diff two replay reports")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help="allowed growth, as a fraction")
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+
+        lines, regressions = compare(old, new, args.threshold)
+        print("\n".join(lines))
+        if regressions:
+            print(f"\n{len(regressions)} regression(s):")
+            print("\n".join(regressions))
+            sys.exit(1)
+        return
+
+    app = load_app(args.database_url, reset=False)
+    instrument(app)
+
+    entries = read_log(args.log) * args.repeat
+    target = ServerTarget(app) if args.server else TestClientTarget(app)
+    try:
+        results, elapsed = replay(app, entries, target, args.concurrency)
+    finally:
+        if args.server:
+            target.close()
+
+    result = report(results, elapsed)
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Benchmark /users search against a large generated users table.
+
+Compares the ranked trigram search in search.py (pg_trgm on PostgreSQL,
+the in-process n-gram index elsewhere) with the old leading-wildcard LIKE
+scan, over a mix of username, bio and location queries.
+
+Example:
+
+    python -m benchmarks.search --users 1000000
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.search
+"""
+
+import argparse
+import json
+import random
+import time
+
+from benchmarks.common import load_app, summarize, Timer
+
+SYLLABLES = ['war', 'bler', 'fin', 'ch', 'rob', 'in', 'jay', 'wren', 'hawk',
+             'lark', 'owl', 'ibis', 'tern', 'kite', 'dove', 'crow', 'swift']
+WORDS = ['love', 'birds', 'coffee', 'hiking', 'music', 'code', 'travel',
+         'photos', 'garden', 'books', 'soccer', 'cooking', 'sunsets', 'cats']
+CITIES = ['Portland', 'Boston', 'Austin', 'Denver', 'Chicago', 'Seattle',
+          'Atlanta', 'Phoenix', 'Oakland', 'Detroit', 'Raleigh', 'Tucson']
+
+BATCH_SIZE = 20000
+
+
+def fake_user(i, rng):
+    name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 3)))
+    return dict(
+        email=f"user{i}@bench.test",
+        username=f"{name}{i}",
+        password="HASHED_PASSWORD",
+        bio=" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 8))),
+        location=rng.choice(CITIES),
+    )
+
+
+def seed(db, count, rng):
+    from models import User
+
+    for start in range(0, count, BATCH_SIZE):
+        db.session.execute(User.__table__.insert(), [
+            fake_user(i, rng)
+            for i in range(start, min(start + BATCH_SIZE, count))
+        ])
+        db.session.commit()
+
+
+def like_scan(q, limit):
+    """The old /users search: unindexable '%q%' over every row."""
+
+    from models import User
+
+    pattern = f"%{q}%"
+    return (User
+            .query
+            .filter(User.username.like(pattern)
+                    | User.bio.like(pattern)
+                    | User.location.like(pattern))
+            .limit(limit)
+            .all())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    load_app(args.database_url)
+
+    import search
+    from models import db
+
+    start = time.perf_counter()
+    seed(db, args.users, rng)
+    seed_seconds = time.perf_counter() - start
+
+    # Common fragments, plus misses (which a LIKE scan reads every row for).
+    queries = [rng.choice([rng.choice(SYLLABLES) + rng.choice(SYLLABLES),
+                           rng.choice(WORDS),
+                           rng.choice(CITIES).lower(),
+                           f"zq{rng.randint(0, 10 ** 6)}"])
+               for _ in range(args.queries)]
+
+    build_seconds = None
+    if db.engine.dialect.name != 'postgresql':
+        start = time.perf_counter()
+        search.index.postings = search.index.build()
+        build_seconds = time.perf_counter() - start
+
+    results = {'trigram': [], 'like_scan': []}
+    for q in queries:
+        with Timer(results['trigram']):
+            search.users(q)
+        with Timer(results['like_scan']):
+            like_scan(q, search.PER_PAGE + 1)
+        db.session.remove()
+
+    report = {
+        'users': args.users,
+        'dialect': db.engine.dialect.name,
+        'seed_seconds': round(seed_seconds, 2),
+        'index_build_seconds': (round(build_seconds, 2)
+                                if build_seconds is not None else None),
+        'search': {name: summarize(samples)
+                   for name, samples in results.items()},
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
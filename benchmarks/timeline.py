@@ -0,0 +1,128 @@
+"""Benchmark push vs. pull timeline paths on a skewed follower graph.
+
+Seeds users whose follower counts follow a power law, so a handful of
+accounts end up over timeline.FANOUT_THRESHOLD, then measures:
+
+- write latency of posting a message (push: fan-out to followers; pull:
+  celebrity post, no fan-out)
+- read latency of the home feed (push: only pushed entries; hybrid: readers
+  who follow at least one celebrity and need the heap merge)
+
+Example:
+
+    python -m benchmarks.timeline --users 20000 --threshold 500
+"""
+
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+
+from benchmarks.common import load_app, summarize, Timer, PowerLaw
+
+
+def seed(db, args, rng):
+    """Insert users, a power-law follow graph and some old messages."""
+
+    from models import User, Follows, Message
+
+    db.session.execute(User.__table__.insert(), [
+        dict(email=f"user{i}@bench.test", username=f"user{i}",
+             password="HASHED_PASSWORD")
+        for i in range(1, args.users + 1)
+    ])
+
+    popularity = PowerLaw(args.users, args.exponent, rng)
+    follows = []
+    for follower in range(1, args.users + 1):
+        degree = min(args.users // 2,
+                     int(rng.paretovariate(1.5) * args.follows_per_user / 3))
+        for followed in popularity.sample(degree):
+            if followed != follower:
+                follows.append(dict(user_being_followed_id=followed,
+                                    user_following_id=follower))
+    db.session.execute(Follows.__table__.insert(), follows)
+
+    activity = PowerLaw(args.users, args.exponent, rng)
+    start = datetime.utcnow() - timedelta(days=30)
+    db.session.execute(Message.__table__.insert(), [
+        dict(text=f"old warble {i}", user_id=activity.draw(),
+             timestamp=start + timedelta(seconds=i))
+        for i in range(args.messages)
+    ])
+
+    db.session.commit()
+    return activity, len(follows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--follows-per-user', type=int, default=30)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--exponent', type=float, default=1.1,
+                        help="power-law exponent for popularity/activity")
+    parser.add_argument('--threshold', type=int, default=500,
+                        help="follower count at which authors are pulled")
+    parser.add_argument('--posts', type=int, default=500)
+    parser.add_argument('--reads', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    load_app(args.database_url)
+
+    import timeline
+    from models import db, Follows, Message, User
+
+    timeline.FANOUT_THRESHOLD = args.threshold
+
+    activity, follow_count = seed(db, args, rng)
+    User.reconcile_counts()
+    timeline.rebuild()
+    db.session.commit()
+
+    celebrities = {user_id for (user_id,) in timeline._celebrities().all()}
+    readers_of_celebrities = {
+        user_id for (user_id,) in (db.session
+                                   .query(Follows.user_following_id)
+                                   .filter(Follows.user_being_followed_id
+                                           .in_(celebrities or [0]))
+                                   .distinct())
+    }
+
+    writes = {'push': [], 'pull': []}
+    for i in range(args.posts):
+        author = activity.draw()
+        path = 'pull' if author in celebrities else 'push'
+        with Timer(writes[path]):
+            msg = Message(text=f"new warble {i}", user_id=author,
+                          timestamp=datetime.utcnow())
+            db.session.add(msg)
+            db.session.flush()
+            User.adjust_counts(author, messages_count=1)
+            timeline.fan_out(msg)
+            db.session.commit()
+
+    reads = {'push': [], 'hybrid': []}
+    for _ in range(args.reads):
+        reader = rng.randint(1, args.users)
+        path = 'hybrid' if reader in readers_of_celebrities else 'push'
+        with Timer(reads[path]):
+            timeline.feed(reader, limit=100)
+        db.session.remove()
+
+    report = {
+        'users': args.users,
+        'follows': follow_count,
+        'threshold': args.threshold,
+        'celebrities': len(celebrities),
+        'write': {path: summarize(samples) for path, samples in writes.items()},
+        'read': {path: summarize(samples) for path, samples in reads.items()},
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
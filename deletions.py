@@ -0,0 +1,256 @@
+"""Deleting messages and whole accounts.
+
+delete_messages() removes some of one user's messages and fixes up what
+was derived from them: counters, timelines and cached fragments.
+
+An account can own far too much to delete inside a request, so
+request_deletion() only deactivates the user and queues an
+AccountDeletion. A worker then deletes their data a bounded batch at a
+time, one phase after another:
+
+- messages: their messages (and the likes and timeline entries of those)
+- likes: likes they gave
+- following, followers: their follows in each direction
+- timeline: their own home timeline
+- user: the user row itself
+
+Each batch is one transaction that also updates the job's progress, and
+other users' counters move with every batch. On PostgreSQL the job row is
+locked with SKIP LOCKED, so any number of workers can share the queue.
+Workers are a background thread per app process (started on the first
+deletion it sees), plus `flask process-deletions` for draining the queue
+from cron or by hand.
+"""
+
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+
+from models import (db, User, Message, Likes, Follows, TimelineEntry,
+                    AccountDeletion)
+import fragments
+import search
+import timeline
+
+# Rows deleted per batch (and transaction).
+BATCH_SIZE = 1000
+
+# How often (seconds) an idle worker thread checks for work anyway, e.g.
+# jobs left behind by a restart.
+POLL_SECONDS = 30
+
+PHASES = ['messages', 'likes', 'following', 'followers', 'timeline', 'user']
+
+logger = logging.getLogger('warbler.deletions')
+
+
+def delete_messages(user_id, message_ids):
+    """Delete those of `message_ids` that `user_id` wrote; returns their ids.
+
+    The DELETE itself checks ownership; what it reports back drives the
+    counter, timeline and fragment cache updates. Doesn't commit.
+    """
+
+    deleted, likers = Message.delete_owned(user_id, message_ids)
+    if not deleted:
+        return deleted
+
+    User.adjust_counts(user_id, messages_count=-len(deleted))
+    for liker_id, count in Counter(likers).items():
+        User.adjust_counts(liker_id, likes_count=-count)
+    timeline.retract(deleted)
+
+    for message_id in deleted:
+        fragments.cache.invalidate(message_id)
+
+    return deleted
+
+
+def request_deletion(user_id):
+    """Deactivate `user_id` now and queue their data for deletion.
+
+    Two small writes, whatever the size of the account. Doesn't commit;
+    call wake() after committing to get a worker started on it.
+    """
+
+    (User
+     .query
+     .filter(User.id == user_id)
+     .update({User.deactivated_at: datetime.utcnow()},
+             synchronize_session=False))
+    # the bulk UPDATE skipped ORM events, so tell search ourselves
+    search.index.invalidate()
+
+    db.session.add(AccountDeletion(user_id=user_id, phase=PHASES[0]))
+
+
+def _first_batch(column, *criteria):
+    return [value for (value,) in (db.session
+                                   .query(column)
+                                   .filter(*criteria)
+                                   .limit(BATCH_SIZE))]
+
+
+def _delete_messages(user_id):
+    ids = _first_batch(Message.id, Message.user_id == user_id)
+    return len(delete_messages(user_id, ids))
+
+
+def _delete_likes(user_id):
+    ids = _first_batch(Likes.message_id, Likes.user_id == user_id)
+    if ids:
+        (Likes
+         .query
+         .filter(Likes.user_id == user_id, Likes.message_id.in_(ids))
+         .delete(synchronize_session=False))
+        (Message
+         .query
+         .filter(Message.id.in_(ids))
+         .update({Message.likes_count: Message.likes_count - 1},
+                 synchronize_session=False))
+    return len(ids)
+
+
+def _follows_deleter(user_col, other_col, counter):
+    """A batch step for follows where `user_col` is the departing user."""
+
+    def step(user_id):
+        ids = _first_batch(other_col, user_col == user_id)
+        if ids:
+            (Follows
+             .query
+             .filter(user_col == user_id, other_col.in_(ids))
+             .delete(synchronize_session=False))
+            User.adjust_counts(ids, **{counter: -1})
+        return len(ids)
+
+    return step
+
+
+def _delete_timeline(user_id):
+    ids = _first_batch(TimelineEntry.message_id,
+                       TimelineEntry.user_id == user_id)
+    if ids:
+        (TimelineEntry
+         .query
+         .filter(TimelineEntry.user_id == user_id,
+                 TimelineEntry.message_id.in_(ids))
+         .delete(synchronize_session=False))
+    return len(ids)
+
+
+def _delete_user(user_id):
+    return (User
+            .query
+            .filter(User.id == user_id)
+            .delete(synchronize_session=False))
+
+
+STEPS = {
+    'messages': _delete_messages,
+    'likes': _delete_likes,
+    'following': _follows_deleter(Follows.user_following_id,
+                                  Follows.user_being_followed_id,
+                                  'followers_count'),
+    'followers': _follows_deleter(Follows.user_being_followed_id,
+                                  Follows.user_following_id,
+                                  'following_count'),
+    'timeline': _delete_timeline,
+    'user': _delete_user,
+}
+
+
+def run_batch():
+    """Run one batch of the oldest unfinished deletion and commit.
+
+    Returns the job worked on, or None if there was nothing to do.
+    """
+
+    query = (AccountDeletion
+             .query
+             .filter(AccountDeletion.finished_at.is_(None))
+             .order_by(AccountDeletion.requested_at))
+
+    if db.engine.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+
+    job = query.first()
+    if job is None:
+        db.session.commit()
+        return None
+
+    deleted = STEPS[job.phase](job.user_id)
+    job.rows_deleted += deleted
+    job.updated_at = datetime.utcnow()
+
+    # a short batch means this phase is done
+    if deleted < BATCH_SIZE:
+        if job.phase == PHASES[-1]:
+            job.finished_at = job.updated_at
+        else:
+            job.phase = PHASES[PHASES.index(job.phase) + 1]
+
+    db.session.commit()
+    return job
+
+
+def run_pending():
+    """Work through every queued deletion; returns the jobs finished."""
+
+    finished = []
+    while True:
+        job = run_batch()
+        if job is None:
+            return finished
+        if job.finished_at:
+            finished.append(job)
+
+
+class Worker:
+    """Background thread that runs queued deletions for one app process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.thread = None
+
+    def wake(self, app):
+        """Start the thread if need be and have it look for work."""
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, args=(app,), daemon=True,
+                    name='account-deletions')
+                self.thread.start()
+        self.event.set()
+
+    def run(self, app):
+        while True:
+            self.event.wait(POLL_SECONDS)
+            self.event.clear()
+
+            with app.app_context():
+                try:
+                    for job in run_pending():
+                        logger.info("Deleted account %s (%s rows)",
+                                    job.user_id, job.rows_deleted)
+                except Exception:
+                    logger.exception("Account deletion batch failed")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+worker = Worker()
+
+
+def wake():
+    """Nudge this process's worker, if the app runs one (DELETION_WORKER)."""
+
+    app = current_app._get_current_object()
+    if app.config['DELETION_WORKER']:
+        worker.wake(app)
@@ -1,6 +1,6 @@
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, TextAreaField
-from wtforms.validators import DataRequired, Email, Length
+from wtforms.validators import DataRequired, Email, Length, Optional
 
 
 class MessageForm(FlaskForm):
@@ -33,4 +33,5 @@ class EditUserForm(FlaskForm):
     image_url = StringField('(Optional) Image URL')
     header_image_url = StringField('(Optional) Image URL')
     bio = StringField('Bio')
-    password = PasswordField('Password', validators=[Length(min=6)])
+    # not needed if the user re-authenticated a few minutes ago
+    password = PasswordField('Password', validators=[Optional(), Length(min=6)])
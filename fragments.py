@@ -0,0 +1,96 @@
+"""Cache of rendered message list items.
+
+A message's row in a feed (author picture and handle, date, text) looks the
+same to every viewer, and a message's text never changes, so the rendered
+HTML only goes stale when the author edits their profile or the message is
+deleted. Rows are cached per message, tagged with the author's
+`profile_version`; a row rendered for an older version counts as a miss.
+Deleting a message drops its row.
+
+Templates render a row with `{{ message_fragment(msg) }}`. The like button
+depends on the viewer, so it stays outside the cached part.
+
+The cache is an LRU in process memory, so each worker process has its own.
+"""
+
+import threading
+from collections import OrderedDict
+
+from flask import Markup
+from sqlalchemy import event
+
+from models import db, Message
+
+FRAGMENT_TEMPLATE = 'messages/fragment.html'
+
+
+class FragmentCache:
+    """LRU map of message id -> (author version, rendered HTML)."""
+
+    def __init__(self, max_entries=10000):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, message_id, version):
+        with self.lock:
+            entry = self.entries.get(message_id)
+            if entry is None or entry[0] != version:
+                return None
+            self.entries.move_to_end(message_id)
+            return entry[1]
+
+    def put(self, message_id, version, html):
+        with self.lock:
+            self.entries[message_id] = (version, html)
+            self.entries.move_to_end(message_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, message_id):
+        with self.lock:
+            self.entries.pop(message_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+cache = FragmentCache()
+
+
+def _message_deleted(mapper, connection, target):
+    cache.invalidate(target.id)
+
+
+def _bulk_deleted(delete_context):
+    # Query.delete() doesn't say which rows went, so start over
+    if delete_context.mapper.class_ is Message:
+        cache.clear()
+
+
+event.listen(Message, 'after_delete', _message_deleted)
+event.listen(db.session, 'after_bulk_delete', _bulk_deleted)
+
+
+def init_app(app):
+    """Size the cache from config and expose message_fragment() to templates."""
+
+    cache.max_entries = app.config['FRAGMENT_CACHE_SIZE']
+
+    @app.template_global()
+    def message_fragment(msg):
+        """The cached HTML for `msg`'s feed row, rendering it on a miss."""
+
+        version = (msg.user_id, msg.user.profile_version)
+        html = cache.get(msg.id, version)
+
+        if html is None:
+            template = app.jinja_env.get_template(FRAGMENT_TEMPLATE)
+            html = template.render(msg=msg)
+            cache.put(msg.id, version, html)
+
+        return Markup(html)
@@ -3,75 +3,202 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+    python generator/create_csvs.py [--users 300] [--messages 1000]
+        [--follows 5000] [--seed 0] [--until 2025-01-01] [--shards 1]
+        [--processes N]
+
+The follow graph and posting activity are skewed the way real ones are: a
+user's share of followers falls off as a power law of their popularity rank
+(--follow-exponent), and how much they post and follow falls off with their
+activity rank (--activity-exponent). The same arguments always produce
+the same files, however many processes write them and whenever they run:
+--until, which messages are dated back from, defaults to a fixed date.
+
+Rows are written as they're generated, and no structure bigger than a few
+arrays of one entry per user is kept, so memory stays bounded. With
+--shards N each table is split into <table>-0.csv ... <table>-N-1.csv,
+written in parallel; seed.py loads them all.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import glob
+import os
+import random
+import sys
+from datetime import datetime
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import (get_random_datetime, PowerLaw, IMAGE_URLS,
+                     HEADER_IMAGE_URLS)
+
+# Message ids are made the app's way; snowflake.py lives one directory up.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import snowflake
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# Messages fall in the two years before --until unless it's given.
+DEFAULT_UNTIL = datetime(2025, 1, 1)
+
+# Every generated user's password is "password".
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
 
-# Generate random profile image URLs to use for users
+class Shape:
+    """Who is popular and who is active; identical in every process."""
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+    def __init__(self, args):
+        self.args = args
+        self.popularity = PowerLaw(args.users, args.follow_exponent,
+                                   random.Random(f"{args.seed}-popularity"))
+        self.activity = PowerLaw(args.users, args.activity_exponent,
+                                 random.Random(f"{args.seed}-activity"))
 
-# Generate random header image URLs to use for users
+    def follow_count(self, user_id, rng):
+        """How many users `user_id` follows: its share of --follows."""
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+        expected = self.args.follows * self.activity.share(user_id)
+        count = int(expected) + (rng.random() < expected % 1)
+        return min(count, self.args.users // 2)
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+def write_users(writer, shape, start, stop, rng, fake):
+    for user_id in range(start + 1, stop + 1):
+        writer.writerow(dict(
+            id=user_id,
+            email=f"{fake.user_name()}{user_id}@{fake.free_email_domain()}",
+            username=f"{fake.user_name()}{user_id}",
+            image_url=rng.choice(IMAGE_URLS),
+            password=PASSWORD,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
+            header_image_url=rng.choice(HEADER_IMAGE_URLS),
             location=fake.city()
         ))
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+def write_messages(writer, shape, start, stop, rng, fake):
+    for i in range(start, stop):
+        text = fake.paragraph()[:MAX_WARBLER_LENGTH]
+        timestamp = get_random_datetime(now=shape.args.until, rng=rng)
+
+        # The message's number fills the worker and sequence bits, so ids
+        # are unique unless millions of messages share a millisecond
+        writer.writerow(dict(
+            id=snowflake.make_id(timestamp, i >> snowflake.SEQUENCE_BITS, i),
+            text=text,
+            timestamp=timestamp,
+            user_id=shape.activity.draw(rng)
         ))
 
-# Generate follows.csv from random pairings of users
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+def write_follows(writer, shape, start, stop, rng, fake):
+    for follower in range(start + 1, stop + 1):
+        count = shape.follow_count(follower, rng)
+        for followed_user in sorted(shape.popularity.sample(count, rng, follower)):
+            writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, write_users),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages),
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows),
+}
+
+
+def csv_path(out_dir, table, shard, shards):
+    name = table if shards == 1 else f"{table}-{shard}"
+    return os.path.join(out_dir, f"{name}.csv")
+
+
+def split(total, shards):
+    """Cut range(total) into `shards` contiguous (start, stop) pieces."""
+
+    bounds = [total * i // shards for i in range(shards + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+_shape = None
+
+
+def init_worker(args):
+    global _shape
+    _shape = Shape(args)
+
+
+def write_shard(task):
+    """Write one shard of one table; returns the file's path."""
+
+    table, shard, start, stop = task
+    args = _shape.args
+    headers, write_rows = TABLES[table]
+
+    # Each shard gets its own stream of randomness, so output doesn't
+    # depend on which process ran it or in what order.
+    rng = random.Random(f"{args.seed}-{table}-{shard}")
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(32))
+
+    path = csv_path(args.out_dir, table, shard, args.shards)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=headers)
+        writer.writeheader()
+        write_rows(writer, _shape, start, stop, rng, fake)
+
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler CSV data.")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000,
+                        help="roughly; nobody follows more than half the users")
+    parser.add_argument('--follow-exponent', type=float, default=1.1,
+                        help="power-law skew of followers across users")
+    parser.add_argument('--activity-exponent', type=float, default=0.8,
+                        help="power-law skew of posting and following")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=DEFAULT_UNTIL,
+                        help="messages fall in the two years before this "
+                             "(default %(default)s)")
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--processes', type=int,
+                        default=min(os.cpu_count() or 1, 8))
+    parser.add_argument('--out-dir', default='generator')
+    args = parser.parse_args()
+
+    # Clear out earlier output so seed.py doesn't load stale shards.
+    for table in TABLES:
+        for path in glob.glob(os.path.join(args.out_dir, f"{table}.csv")) + \
+                glob.glob(os.path.join(args.out_dir, f"{table}-*.csv")):
+            os.remove(path)
+
+    sizes = {'users': args.users, 'messages': args.messages,
+             'follows': args.users}
+    tasks = [(table, shard, start, stop)
+             for table in TABLES
+             for shard, (start, stop) in enumerate(split(sizes[table],
+                                                         args.shards))]
+
+    processes = min(args.processes, len(tasks))
+    if processes <= 1:
+        init_worker(args)
+        for path in map(write_shard, tasks):
+            print(f"Wrote {path}")
+        return
+
+    with Pool(processes, initializer=init_worker, initargs=(args,)) as pool:
+        for path in pool.imap_unordered(write_shard, tasks):
+            print(f"Wrote {path}")
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
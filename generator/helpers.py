@@ -1,14 +1,103 @@
 """Support functions for CSV generation."""
 
+import random
+from array import array
+from bisect import bisect_left
 from datetime import datetime
-from random import uniform
+from itertools import accumulate
 
+# Profile pictures, served by randomuser.me.
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+IMAGE_URLS = [
+    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
+    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
+    for i in range(count)
+]
 
-    now = datetime.now()
+# Header images, as once returned by splashbase's API. Kept here so
+# generating data doesn't need the network.
+
+HEADER_IMAGE_URLS = [
+    f"https://splashbase.s3.amazonaws.com/unsplash/regular/tumblr_{name}_1280.jpg"
+    for name in """
+        mnh0n9pHJW1st5lhmo1 mnh0uemhCk1st5lhmo1 mnh121HEWa1st5lhmo1
+        mnh17lfd9R1st5lhmo1 mnh1d7s3UD1st5lhmo1 mnh1jdFvHR1st5lhmo1
+        mnh1uhYnog1st5lhmo1 mnh25vNOvI1st5lhmo1 mnh29fxz111st5lhmo1
+        mnh2m1hnS81st5lhmo1 mo1h6tGOZf1st5lhmo1 mo2wz2LTCs1st5lhmo1
+        mo2x3aAnRH1st5lhmo1 mo2x80NkDu1st5lhmo1 mo2x9xqeef1st5lhmo1
+        mo2xbk8JUK1st5lhmo1 mo2xdqmle51st5lhmo1 mo2xfarCvW1st5lhmo1
+        mo2xgqdEFn1st5lhmo1 mo2xijE2nr1st5lhmo1 mopq4kHmAg1st5lhmo1
+        mopq69jlcS1st5lhmo1 mopq8fyQwI1st5lhmo1 mopqamedKu1st5lhmo1
+        mopqc3ZZcz1st5lhmo1 mopqdfx05t1st5lhmo1 mopqfpSTPN1st5lhmo1
+        mopqhxFulr1st5lhmo1 mopqj9QUeq1st5lhmo1 mopqkkwK2M1st5lhmo1
+        mp6rzyNlAN1st5lhmo1 mp6s1hAudo1st5lhmo1 mp6s32zb6l1st5lhmo1
+        mp6s4dzqHA1st5lhmo1 mp6s661UgK1st5lhmo1 mp6s7lR1lS1st5lhmo1
+        mp6s995bvI1st5lhmo1 mp6sasSvPZ1st5lhmo1 mp6scv2xrZ1st5lhmo1
+        mpp6f50W261st5lhmo1 mpp6gwrYvm1st5lhmo1 mpp6l06zXi1st5lhmo1
+        mpp6poZxE51st5lhmo1 mpp6tjdFhf1st5lhmo1 mpp6w0dxAm1st5lhmo1
+    """.split()
+]
+
+
+def get_random_datetime(year_gap=2, now=None, rng=random):
+    """Get a random datetime within the few years before `now`."""
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+class PowerLaw:
+    """Ids 1..n ranked in a random order, weighted 1 / rank ** exponent.
+
+    Ids, ranks and cumulative weights live in flat arrays, so this stays
+    around 24 bytes per id however large n gets.
+    """
+
+    def __init__(self, n, exponent, rng):
+        self.n = n
+        self.ids = array('l', range(1, n + 1))
+        rng.shuffle(self.ids)
+
+        self.ranks = array('l', [0]) * (n + 1)
+        for rank, id in enumerate(self.ids, 1):
+            self.ranks[id] = rank
+
+        self.weights = array('d', accumulate(
+            1 / rank ** exponent for rank in range(1, n + 1)))
+        self.total = self.weights[-1] if n else 0.0
+
+    def share(self, id):
+        """Fraction of all draws that land on `id`."""
+
+        rank = self.ranks[id]
+        below = self.weights[rank - 2] if rank > 1 else 0.0
+        return (self.weights[rank - 1] - below) / self.total
+
+    def draw(self, rng):
+        return self.ids[bisect_left(self.weights, rng.random() * self.total)]
+
+    def sample(self, k, rng, exclude):
+        """`k` distinct ids other than `exclude`, favouring the top ranks.
+
+        After a few rounds of weighted draws (which mostly repeat the top
+        ids once those are taken) the rest are filled in uniformly. Keep k
+        at most half of n so that stays cheap.
+        """
+
+        picked = set()
+        for _ in range(4 * k):
+            if len(picked) == k:
+                return picked
+            id = self.draw(rng)
+            if id != exclude:
+                picked.add(id)
+
+        while len(picked) < k:
+            id = rng.randint(1, self.n)
+            if id != exclude:
+                picked.add(id)
+
+        return picked
@@ -0,0 +1,112 @@
+"""HTTP caching policy for Warbler responses.
+
+- Pages personalized for a logged-in user: `private, no-store`.
+- Public pages that opt in through conditional() (profiles and single
+  messages, seen logged out): a strong ETag and `public, no-cache`, so
+  browsers and the CDN keep a copy and revalidate it; a matching
+  If-None-Match gets a bodiless 304 without rendering the page.
+- Static files linked through static_url(), which adds a content hash to
+  the URL: cached for a year as immutable, as long as the hash is the
+  file's current one. Other static requests revalidate.
+- Anything else: `no-cache`.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, g, request, session, make_response, url_for
+
+# A year, the most browsers honour.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_fingerprints = {}
+
+
+def cacheable():
+    """May this response be shared with other viewers?
+
+    Only when nobody is logged in and there are no flashed messages
+    waiting to be shown.
+    """
+
+    return not g.get('user') and '_flashes' not in session
+
+
+def make_etag(*parts):
+    """A strong ETag over `parts` (and the requested URL)."""
+
+    key = "|".join(str(part) for part in (request.full_path,) + parts)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def conditional(etag_parts, render):
+    """Respond from `render()` with an ETag, or 304 if the client has it.
+
+    `etag_parts()` returns the values the ETag is made from, and must cover
+    everything the page shows. When the response isn't cacheable (see
+    above) neither is called but render().
+    """
+
+    if not cacheable():
+        return render()
+
+    etag = make_etag(*etag_parts())
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, no-cache'
+    return response
+
+
+def fingerprint(filename):
+    """A hash of the contents of static file `filename`, cached by mtime."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    mtime = os.path.getmtime(path)
+
+    cached = _fingerprints.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()[:12]
+        cached = _fingerprints[path] = (mtime, digest)
+
+    return cached[1]
+
+
+def static_url(filename):
+    """URL for a static file, fingerprinted with a hash of its contents."""
+
+    return url_for('static', filename=filename, v=fingerprint(filename))
+
+
+def add_cache_headers(response):
+    """Apply the caching policy, unless the view already set one."""
+
+    if 'Cache-Control' in response.headers and request.endpoint != 'static':
+        return response
+
+    if request.endpoint == 'static':
+        # only the file's current hash; a stale or made-up `v` would pin
+        # whatever is served now for a year
+        if (response.status_code in (200, 304) and request.args.get('v')
+                == fingerprint(request.view_args['filename'])):
+            policy = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        else:
+            policy = 'public, no-cache'
+    elif g.get('user'):
+        policy = 'private, no-store'
+    else:
+        policy = 'no-cache'
+
+    response.headers['Cache-Control'] = policy
+    return response
+
+
+def init_app(app):
+    """Install the caching policy and the static_url() template helper."""
+
+    app.add_template_global(static_url)
+    app.after_request(add_cache_headers)
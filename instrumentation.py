@@ -0,0 +1,325 @@
+"""SQL and request instrumentation for Warbler.
+
+Counts and times the statements the app sends to the database through
+SQLAlchemy's cursor events on the `db` engine from models.py, and, once
+init_app() has been called, aggregates per-endpoint request metrics:
+
+- request count and total request time
+- query count and total DB time
+- total template render time
+- a sample of the slowest statements
+
+They're served from /metrics in Prometheus text format to scrapers that
+present METRICS_TOKEN as a bearer token (without one configured, /metrics
+is a 404). Slow statements are exposed only by a fingerprint of their SQL;
+the statement itself goes to the log. A JSON log line is also written per
+request. Metrics live in process memory, so each worker process reports
+its own.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import abort, current_app, g, has_request_context, request, Response
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+from models import db
+
+# Statements slower than this (seconds) are kept as slow-query samples.
+SLOW_QUERY_SECONDS = 0.1
+
+# How many slow-query samples to keep.
+SLOW_QUERY_SAMPLES = 20
+
+logger = logging.getLogger('warbler.requests')
+
+
+class QueryCounter:
+    """Cursor-execute listener that records every statement it sees."""
+
+    def __init__(self):
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.statements.append(statement)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements executed inside the `with` block.
+
+        with count_queries() as queries:
+            client.get("/")
+        print(queries.count)
+    """
+
+    counter = QueryCounter()
+    event.listen(db.engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', counter)
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail if the `with` block executes more than `limit` SQL statements.
+
+    Meant for tests, to catch N+1 regressions in views.
+    """
+
+    with count_queries() as counter:
+        yield counter
+
+    if counter.count > limit:
+        statements = "\n\n".join(counter.statements)
+        raise AssertionError(
+            f"{counter.count} queries executed, expected at most {limit}:"
+            f"\n\n{statements}")
+
+
+class RequestMetrics:
+    """What one request spent its time on; lives on `g.metrics`."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_start = None
+
+
+class Registry:
+    """Per-endpoint totals across requests, safe to update from threads."""
+
+    COUNTERS = [
+        ('requests_total', "Requests handled."),
+        ('request_seconds_total', "Time spent handling requests."),
+        ('db_queries_total', "SQL statements executed."),
+        ('db_seconds_total', "Time spent executing SQL statements."),
+        ('template_seconds_total', "Time spent rendering templates."),
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = defaultdict(lambda: defaultdict(float))
+            self.slow_queries = []
+
+    def record(self, endpoint, metrics, elapsed):
+        with self.lock:
+            totals = self.endpoints[endpoint]
+            totals['requests_total'] += 1
+            totals['request_seconds_total'] += elapsed
+            totals['db_queries_total'] += metrics.queries
+            totals['db_seconds_total'] += metrics.db_seconds
+            totals['template_seconds_total'] += metrics.template_seconds
+
+    def record_slow_query(self, endpoint, statement, seconds):
+        """Keep the SLOW_QUERY_SAMPLES slowest statements seen.
+
+        Each is logged with its fingerprint, which is all render() shows.
+        """
+
+        fingerprint = query_fingerprint(statement)
+        logger.warning(json.dumps({
+            'slow_query': fingerprint,
+            'endpoint': endpoint,
+            'seconds': round(seconds, 6),
+            'statement': " ".join(statement.split()),
+        }))
+
+        with self.lock:
+            self.slow_queries.append((seconds, endpoint, fingerprint))
+            self.slow_queries.sort(reverse=True)
+            del self.slow_queries[SLOW_QUERY_SAMPLES:]
+
+    def render(self):
+        """All metrics in Prometheus text exposition format."""
+
+        lines = []
+        with self.lock:
+            for name, help in self.COUNTERS:
+                lines.append(f"# HELP warbler_{name} {help}")
+                lines.append(f"# TYPE warbler_{name} counter")
+                for endpoint, totals in sorted(self.endpoints.items()):
+                    lines.append(
+                        f'warbler_{name}{{endpoint="{_escape(endpoint)}"}} '
+                        f'{_number(totals[name])}')
+
+            lines.append("# HELP warbler_slow_query_seconds "
+                         "Slowest recent SQL statements.")
+            lines.append("# TYPE warbler_slow_query_seconds gauge")
+            for seconds, endpoint, fingerprint in self.slow_queries:
+                lines.append(
+                    f'warbler_slow_query_seconds{{'
+                    f'endpoint="{_escape(endpoint)}",'
+                    f'query="{fingerprint}"}} {seconds:.6f}')
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def query_fingerprint(statement):
+    """A short, stable name for a SQL statement, ignoring whitespace."""
+
+    normalized = " ".join(statement.split())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+
+
+def _escape(value):
+    """Escape a Prometheus label value."""
+
+    value = str(value)[:200]
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _number(value):
+    return str(int(value)) if float(value).is_integer() else f"{value:.6f}"
+
+
+def _current_metrics():
+    if has_request_context():
+        return g.get('metrics')
+    return None
+
+
+# The start time rides on the statement's execution context, which is
+# thrown away with it, so a statement that raises leaves nothing behind.
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None:
+        context._warbler_query_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = getattr(context, '_warbler_query_start', None)
+    metrics = _current_metrics()
+
+    if start is None or metrics is None:
+        return
+
+    seconds = time.perf_counter() - start
+
+    metrics.queries += 1
+    metrics.db_seconds += seconds
+
+    if seconds >= SLOW_QUERY_SECONDS:
+        registry.record_slow_query(request.endpoint, statement, seconds)
+
+
+# Connected for every sender: g.metrics is only set in requests of an app
+# that init_app() was called on, so other apps' renders are ignored.
+
+def _before_render_template(sender, template, context, **extra):
+    metrics = _current_metrics()
+    if metrics is not None:
+        metrics.template_start = time.perf_counter()
+
+
+def _template_rendered(sender, template, context, **extra):
+    metrics = _current_metrics()
+    if metrics is not None and metrics.template_start is not None:
+        metrics.template_seconds += time.perf_counter() - metrics.template_start
+        metrics.template_start = None
+
+
+def _start_request():
+    g.metrics = RequestMetrics()
+
+
+def _finish_request(response):
+    metrics = g.get('metrics')
+    if metrics is None:
+        return response
+
+    elapsed = time.perf_counter() - metrics.start
+    endpoint = request.endpoint or 'unmatched'
+    registry.record(endpoint, metrics, elapsed)
+
+    # Lines carry enough to be replayed by benchmarks/replay.py.
+    user = g.get('user')
+    logger.info(json.dumps({
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'user_id': user.id if user else None,
+        'endpoint': endpoint,
+        'status': response.status_code,
+        'duration_ms': round(elapsed * 1000, 3),
+        'db_queries': metrics.queries,
+        'db_ms': round(metrics.db_seconds * 1000, 3),
+        'template_ms': round(metrics.template_seconds * 1000, 3),
+    }))
+
+    return response
+
+
+def metrics_view():
+    """Serve the metrics registry to a Prometheus scraper.
+
+    Only with `Authorization: Bearer <METRICS_TOKEN>`; 404 when no token is
+    configured, 403 for a wrong one.
+    """
+
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        abort(404)
+
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied.encode('utf-8'),
+                               f"Bearer {token}".encode('utf-8')):
+        abort(403)
+
+    return Response(registry.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """Start collecting request metrics for `app` and serve /metrics.
+
+    Calling it again for the same app does nothing.
+    """
+
+    if 'warbler_instrumentation' in app.extensions:
+        return
+    app.extensions['warbler_instrumentation'] = registry
+
+    with app.app_context():
+        engine = db.engine
+
+    if not event.contains(engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+    # Strongly, and not with `app` as the sender: blinker holds both weakly,
+    # and cleaning up after one collected at interpreter exit fails
+    before_render_template.connect(_before_render_template, weak=False)
+    template_rendered.connect(_template_rendered, weak=False)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        logger.setLevel(logging.INFO)
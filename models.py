@@ -2,13 +2,36 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, DDL
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from passwords import hasher
+import snowflake
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
+class utcnow(FunctionElement):
+    """The database's current time in UTC, for server-side defaults."""
+
+    type = db.DateTime()
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    # CURRENT_TIMESTAMP is when the transaction began, not the insert, and
+    # both are in the session's time zone; columns hold naive UTC
+    return "TIMEZONE('utc', statement_timestamp())"
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -26,26 +49,211 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with the followed user; this covers lookups
+    # that start from the follower ("who does X follow?").
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 user_following_id, user_being_followed_id),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? (A primary key lookup.)"""
+
+        query = cls.query.filter_by(user_following_id=follower_id,
+                                    user_being_followed_id=followed_id)
+
+        return db.session.query(query.exists()).scalar()
+
+    @classmethod
+    def follow(cls, follower_id, followed_ids):
+        """Have `follower_id` follow each of `followed_ids` not yet followed.
+
+        One INSERT ... SELECT that skips unknown or deactivated users, the
+        follower themselves and existing follows (ON CONFLICT DO NOTHING, so
+        it's safe against concurrent requests). Returns the ids actually
+        newly followed, so callers can update counters and timelines for
+        just those. Doesn't commit.
+        """
+
+        followed_ids = set(followed_ids) - {follower_id}
+        if not followed_ids:
+            return []
+
+        candidates = (db.select([db.literal(follower_id), User.id])
+                      .where(User.id.in_(followed_ids)
+                             & User.deactivated_at.is_(None)))
+        columns = ['user_following_id', 'user_being_followed_id']
+
+        if db.engine.dialect.name == 'postgresql':
+            insert = (postgresql.insert(cls.__table__)
+                      .from_select(columns, candidates)
+                      .on_conflict_do_nothing()
+                      .returning(cls.user_being_followed_id))
+            return [user_id for (user_id,) in db.session.execute(insert)]
+
+        # Elsewhere (SQLite) there's no RETURNING; work out the new ones
+        # first, then insert those.
+        already = (db.session
+                   .query(cls.user_being_followed_id)
+                   .filter(cls.user_following_id == follower_id,
+                           cls.user_being_followed_id.in_(followed_ids)))
+        new = candidates.where(User.id.notin_(already.subquery()))
+        added = [user_id for (_, user_id) in db.session.execute(new)]
+
+        if added:
+            db.session.execute(
+                cls.__table__.insert().prefix_with('OR IGNORE'),
+                [{'user_following_id': follower_id,
+                  'user_being_followed_id': user_id} for user_id in added])
+
+        return added
+
+    @classmethod
+    def unfollow(cls, follower_id, followed_id):
+        """Stop `follower_id` following `followed_id`, in one DELETE.
+
+        Returns whether there was a follow to remove. Doesn't commit.
+        """
+
+        deleted = (cls
+                   .query
+                   .filter_by(user_following_id=follower_id,
+                              user_being_followed_id=followed_id)
+                   .delete(synchronize_session=False))
+
+        return deleted > 0
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
+    user_id = db.Column(
         db.Integer,
-        primary_key=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # Each user likes a message at most once (the primary key); this
+    # covers going from a message to its likers, and the cascade on delete.
+    __table_args__ = (
+        db.Index('ix_likes_message_id', message_id),
     )
 
+    # One round trip: unlike if there's a like to delete, otherwise like
+    # (if the message exists), and move both counters by the net change.
+    # All CTEs see the same snapshot, so the insert checks `deleted`
+    # rather than the table, and a concurrent toggle that got there first
+    # makes this a no-op (delta 0) instead of an error.
+    TOGGLE_SQL = db.text("""
+        WITH target AS (
+            SELECT id FROM messages WHERE id = :message_id
+        ), deleted AS (
+            DELETE FROM likes
+            WHERE user_id = :user_id AND message_id = :message_id
+            RETURNING 1
+        ), inserted AS (
+            INSERT INTO likes (user_id, message_id)
+            SELECT :user_id, id FROM target
+            WHERE NOT EXISTS (SELECT 1 FROM deleted)
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+        ), delta AS (
+            SELECT (SELECT count(*) FROM inserted)
+                   - (SELECT count(*) FROM deleted) AS n
+        ), user_count AS (
+            UPDATE users SET likes_count = likes_count + delta.n
+            FROM delta WHERE users.id = :user_id AND delta.n <> 0
+        ), message_count AS (
+            UPDATE messages SET likes_count = messages.likes_count + delta.n
+            FROM delta WHERE messages.id = :message_id AND delta.n <> 0
+        )
+        SELECT (SELECT n FROM delta), EXISTS (SELECT 1 FROM target)
+    """)
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like `message_id` as `user_id`, or unlike it if already liked.
+
+        Keeps the user's and the message's likes_count in step. Returns 1
+        (liked), -1 (unliked), 0 (a concurrent toggle beat us to it) or
+        None if there's no such message. Doesn't commit.
+        """
+
+        if db.engine.dialect.name == 'postgresql':
+            delta, found = db.session.execute(
+                cls.TOGGLE_SQL,
+                {'user_id': user_id, 'message_id': message_id}).first()
+            return delta if found else None
+
+        return cls._toggle_fallback(user_id, message_id)
+
+    @classmethod
+    def _toggle_fallback(cls, user_id, message_id):
+        table = cls.__table__
+        delta = -db.session.execute(
+            table.delete().where((table.c.user_id == user_id)
+                                 & (table.c.message_id == message_id))
+        ).rowcount
+
+        if not delta:
+            if not db.session.query(
+                    Message.query.filter_by(id=message_id).exists()).scalar():
+                return None
+
+            delta = db.session.execute(
+                table.insert().prefix_with('OR IGNORE'),
+                {'user_id': user_id, 'message_id': message_id}).rowcount
+
+        if delta:
+            User.adjust_counts(user_id, likes_count=delta)
+            (Message
+             .query
+             .filter_by(id=message_id)
+             .update({Message.likes_count: Message.likes_count + delta},
+                     synchronize_session=False))
+
+        return delta
+
+
+class TimelineEntry(db.Model):
+    """Materialized home-feed row: `message_id` belongs in `user_id`'s feed.
+
+    Rows are written when a followed user posts (fan-out-on-write) so that
+    reading the home feed is a range scan over one user's entries. Message
+    ids sort by time, so the primary key's index serves that scan.
+    """
+
+    __tablename__ = 'timeline_entries'
+
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_author', user_id, author_id),
     )
 
 
@@ -94,6 +302,56 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts for the profile header, kept up to date by the
+    # routes through adjust_counts() and repaired by reconcile_counts().
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+        index=True,
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped on every profile edit, so cached renderings of the user's
+    # messages (see fragments.py) know to re-render.
+
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set when the user deletes their account. From then on they can't log
+    # in and don't show up anywhere; deletions.py removes their data in the
+    # background and finally the row itself.
+
+    deactivated_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -121,14 +379,121 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(self.id, other_user.id)
+
+    def following_ids(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        One query for a whole page of users; returns a set of ids, so
+        templates can check `user.id in followed` per card.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+
+        return {user_id for (user_id,) in rows}
+
+    def liked_ids(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Like following_ids(): one primary-key range query for just the
+        messages on the page, however many this user has ever liked.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids)))
+
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def get_active_or_404(cls, user_id):
+        """The user with `user_id`, unless missing or deactivated (404)."""
+
+        return (cls
+                .query
+                .filter(cls.id == user_id, cls.deactivated_at.is_(None))
+                .first_or_404())
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to the counter columns of `user_ids`.
+
+        `user_ids` may be a single id, a list of ids or a subquery of ids.
+        The arithmetic happens in the UPDATE so concurrent requests can't
+        lose increments. Doesn't commit; the caller's transaction does.
+        """
+
+        if isinstance(user_ids, int):
+            criterion = cls.id == user_ids
+        else:
+            criterion = cls.id.in_(user_ids)
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+
+        cls.query.filter(criterion).update(values, synchronize_session=False)
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every user's counters from the underlying tables.
+
+        Runs one GROUP BY per counter and only writes rows that drifted.
+        Returns the number of users repaired.
+        """
+
+        actual = {}
+        sources = [
+            ('messages_count', Message.user_id),
+            ('following_count', Follows.user_following_id),
+            ('followers_count', Follows.user_being_followed_id),
+            ('likes_count', Likes.user_id),
+        ]
+
+        for name, user_col in sources:
+            counts = (db.session
+                      .query(user_col, db.func.count())
+                      .group_by(user_col))
+            for user_id, count in counts:
+                actual.setdefault(user_id, {})[name] = count
+
+        names = [name for name, _ in sources]
+        stored = db.session.query(cls.id, *[getattr(cls, n) for n in names])
+
+        repairs = []
+        for user_id, *values in stored:
+            expected = actual.get(user_id, {})
+            row = [expected.get(name, 0) for name in names]
+            if row != values:
+                repair = {f"new_{name}": count
+                          for name, count in zip(names, row)}
+                repairs.append(dict(repair, user_id=user_id))
+
+        if repairs:
+            db.session.execute(
+                cls.__table__.update()
+                .where(cls.id == db.bindparam('user_id'))
+                .values({name: db.bindparam(f"new_{name}")
+                         for name in names}),
+                repairs)
+
+        return len(repairs)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +502,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('utf-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -160,24 +525,90 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username,
+                                   deactivated_at=None).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's (already loaded) password hash?
+
+        If the stored hash was made with a different work factor than the
+        one configured, it's replaced (the caller commits).
+        """
+
+        if not hasher.check(self.password, password):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+
+        return True
+
+
+class AccountDeletion(db.Model):
+    """A deactivated user whose data is being deleted in the background.
+
+    deletions.py works through `phase` a batch at a time, counting rows
+    removed, and stamps `finished_at` once the user row itself is gone.
+    `user_id` isn't a foreign key, so the record outlives the user.
+    """
+
+    __tablename__ = 'account_deletions'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    phase = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    rows_deleted = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    requested_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+        index=True,
+    )
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # A snowflake (see snowflake.py): ids sort by when they were made, so
+    # feeds order and page by id alone.
+
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=snowflake.next_id,
     )
 
     text = db.Column(
@@ -188,7 +619,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -197,8 +628,108 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # How many users like this message; kept up to date by Likes.toggle()
+    # and repaired by reconcile_counts().
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    __table_args__ = (
+        db.Index('ix_messages_user_id', user_id, id.desc()),
+    )
+
+    # Deletes the messages `user_id` owns out of `message_ids` and, from
+    # the same snapshot (before the likes cascade away), reports who had
+    # liked each one.
+    DELETE_OWNED_SQL = db.text("""
+        WITH deleted AS (
+            DELETE FROM messages
+            WHERE id = ANY(:message_ids) AND user_id = :user_id
+            RETURNING id
+        )
+        SELECT deleted.id, likes.user_id
+        FROM deleted LEFT JOIN likes ON likes.message_id = deleted.id
+    """)
+
+    @classmethod
+    def delete_owned(cls, user_id, message_ids):
+        """Delete those of `message_ids` that `user_id` wrote.
+
+        Anything else in `message_ids` is left alone, so this doubles as
+        the ownership check. Returns (deleted ids, ids of the users who had
+        liked them, once per like) for the caller to update counters,
+        timelines and caches with. Doesn't commit.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return [], []
+
+        if db.engine.dialect.name == 'postgresql':
+            rows = db.session.execute(
+                cls.DELETE_OWNED_SQL,
+                {'user_id': user_id, 'message_ids': message_ids}).fetchall()
+        else:
+            rows = (db.session
+                    .query(cls.id, Likes.user_id)
+                    .outerjoin(Likes, Likes.message_id == cls.id)
+                    .filter(cls.id.in_(message_ids), cls.user_id == user_id)
+                    .all())
+            if rows:
+                (cls
+                 .query
+                 .filter(cls.id.in_({id for id, _ in rows}))
+                 .delete(synchronize_session=False))
+
+        deleted = sorted({id for id, _ in rows})
+        likers = [liker for _, liker in rows if liker is not None]
+
+        return deleted, likers
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute likes_count where it drifted from the likes table.
+
+        Returns the number of messages repaired.
+        """
+
+        actual = (db.select([db.func.count()])
+                  .where(Likes.message_id == cls.id)
+                  .as_scalar())
+
+        return (cls
+                .query
+                .filter(cls.likes_count != actual)
+                .update({cls.likes_count: actual},
+                        synchronize_session=False))
+
+
+# Text searched by /users?q= (see search.py). On PostgreSQL it's covered by
+# a pg_trgm GIN index; queries must use this exact expression to hit it.
+USER_SEARCH_DOCUMENT = (
+    "(username || ' ' || coalesce(bio, '') || ' ' || coalesce(location, ''))")
+
+USER_SEARCH_INDEX_SQL = (
+    f"CREATE INDEX ix_users_search_trgm ON users "
+    f"USING gin ({USER_SEARCH_DOCUMENT} gin_trgm_ops)")
+
+event.listen(
+    db.metadata,
+    'before_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    .execute_if(dialect='postgresql'))
+
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL(USER_SEARCH_INDEX_SQL).execute_if(dialect='postgresql'))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
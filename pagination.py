@@ -0,0 +1,67 @@
+"""Keyset (cursor) pagination for Warbler.
+
+Instead of OFFSET, each page remembers the sort key of its last row, and the
+next page asks for rows strictly "before" that key. With an index on the
+sort columns every page is a range scan that costs the same as the first.
+
+Every list is ordered by an id (message ids sort by time, see
+snowflake.py), so a cursor is just the last id seen: message feeds go
+newest first and take it in the `before` query param, user lists go in id
+order and take it in `after`.
+"""
+
+
+class Page:
+    """One page of results plus the cursor for the page after it."""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def parse_id_cursor(raw):
+    """Decode an id cursor; None (first page) if missing or malformed."""
+
+    try:
+        return int(raw)
+    except (TypeError, ValueError):
+        return None
+
+
+def before_id(query, id_col, cursor):
+    """Order `query` by descending id and skip everything down to `cursor`."""
+
+    if cursor is not None:
+        query = query.filter(id_col < cursor)
+
+    return query.order_by(id_col.desc())
+
+
+def after_id(query, id_col, cursor):
+    """Order `query` by ascending id and skip everything up to `cursor`."""
+
+    if cursor is not None:
+        query = query.filter(id_col > cursor)
+
+    return query.order_by(id_col)
+
+
+def paginate(rows, limit, cursor_for=lambda row: row.id):
+    """Build a Page from up to `limit + 1` rows fetched in page order.
+
+    The extra row only tells us whether there is another page; the cursor
+    for it comes from the last row kept.
+    """
+
+    rows = list(rows)
+    if len(rows) <= limit:
+        return Page(rows, None)
+
+    rows = rows[:limit]
+    return Page(rows, cursor_for(rows[-1]))
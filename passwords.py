@@ -0,0 +1,135 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow and CPU-bound, so hashing in the request worker
+lets a burst of logins starve every other route. Here hashes run in a small
+dedicated process pool instead. The number of hashes in flight (running or
+queued) is capped; past the cap we refuse with HashingBusy, which the app
+turns into a 429, rather than letting requests pile up behind bcrypt. A
+hash that takes longer than the timeout, or is lost because a pool process
+died, is refused the same way, and a broken pool is replaced for the next
+request.
+
+With `workers=0` hashing runs inline, which is simplest for scripts.
+"""
+
+import threading
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+
+class HashingBusy(Exception):
+    """Raised when too many password hashes are already in flight."""
+
+
+def _hash(password, rounds):
+    salt = bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def _check(hashed, password):
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+class PasswordHasher:
+    """bcrypt hashing on a bounded process pool."""
+
+    def __init__(self, rounds=12, workers=0, max_pending=16, timeout=10):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.configure(rounds, workers, max_pending, timeout)
+
+    def configure(self, rounds, workers, max_pending, timeout):
+        """(Re)set the work factor and pool size; the pool starts lazily."""
+
+        self._discard(self.pool)
+
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self.pending = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+
+        if not self.pending.acquire(blocking=False):
+            raise HashingBusy()
+
+        pool = None
+        try:
+            pool = self._pool()
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            self.pending.release()
+            self._discard(pool)
+            raise HashingBusy()
+        except BaseException:
+            self.pending.release()
+            raise
+
+        future.add_done_callback(lambda _: self.pending.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except futures.TimeoutError:
+            raise HashingBusy()
+        except BrokenProcessPool:
+            self._discard(pool)
+            raise HashingBusy()
+
+    def _pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = futures.ProcessPoolExecutor(
+                    max_workers=self.workers)
+            return self.pool
+
+    def _discard(self, pool):
+        """Drop `pool` if it's still the current one (the next hash starts
+        a new one) and stop its processes."""
+
+        if pool is None:
+            return
+        with self.lock:
+            if self.pool is pool:
+                self.pool = None
+
+        # shutdown() alone leaves a busy or wedged process running, and the
+        # interpreter then waits on it forever at exit
+        for process in list((pool._processes or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=True)
+
+    def hash(self, password):
+        """Hash `password` at the configured work factor."""
+
+        return self._run(_hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match the stored `hashed` password?"""
+
+        return self._run(_check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different work factor than configured?"""
+
+        # bcrypt hashes look like $2b$<cost>$<salt+hash>
+        return int(hashed.split('$')[2]) != self.rounds
+
+
+hasher = PasswordHasher()
+
+
+def init_app(app):
+    """Configure the shared hasher from `app`'s config; 429 when saturated."""
+
+    hasher.configure(rounds=app.config['BCRYPT_LOG_ROUNDS'],
+                     workers=app.config['PASSWORD_HASH_WORKERS'],
+                     max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+                     timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+
+    @app.errorhandler(HashingBusy)
+    def hashing_busy(error):
+        return ("Too many sign-ins right now. Please try again shortly.",
+                429, {'Retry-After': '1'})
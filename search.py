@@ -0,0 +1,171 @@
+"""User search for /users?q=.
+
+Matches the query against each user's username, bio and location and
+returns ranked, paginated results.
+
+On PostgreSQL this uses pg_trgm: a GIN trigram index over
+USER_SEARCH_DOCUMENT (see models.py) serves both substring (ILIKE) and
+fuzzy word-similarity matches, ranked by word_similarity(). Other databases
+(SQLite in test runs) get an in-process trigram index built the same way
+pg_trgm splits text, so results rank roughly the same.
+"""
+
+import re
+import threading
+from array import array
+from collections import Counter, defaultdict
+
+from sqlalchemy import event
+
+from models import db, User, USER_SEARCH_DOCUMENT
+from pagination import Page
+
+# Users per page of search results.
+PER_PAGE = 60
+
+# Deep pages of fuzzy results aren't useful; stop paging after this many.
+MAX_PAGES = 20
+
+# Minimum share of the query's trigrams a result must contain.
+MIN_SIMILARITY = 0.5
+
+
+def users(q, page=1, per_page=None):
+    """Return a Page of users matching `q`, best matches first.
+
+    The Page's `next_cursor` is the next page number (or None).
+    """
+
+    per_page = per_page or PER_PAGE
+    page = max(1, min(page, MAX_PAGES))
+    offset = (page - 1) * per_page
+
+    if db.engine.dialect.name == 'postgresql':
+        found = _search_postgres(q, offset, per_page + 1)
+    else:
+        found = _search_fallback(q, offset, per_page + 1)
+
+    if len(found) > per_page and page < MAX_PAGES:
+        return Page(found[:per_page], page + 1)
+
+    return Page(found[:per_page], None)
+
+
+def _search_postgres(q, offset, limit):
+    document = db.literal_column(USER_SEARCH_DOCUMENT)
+
+    # Named binds: the names SQLAlchemy would derive from the literal
+    # document hold quotes and parentheses that psycopg2 can't parse. For
+    # the same reason the `%>` operator is written with its `%` doubled.
+    query = db.bindparam('q', q)
+    pattern = db.bindparam('pattern', _like_pattern(q))
+
+    return (User
+            .query
+            .filter(User.deactivated_at.is_(None),
+                    db.or_(document.ilike(pattern),
+                           document.op('%%>')(query)))
+            .order_by(db.func.word_similarity(query, document).desc(),
+                      User.id)
+            .offset(offset)
+            .limit(limit)
+            .all())
+
+
+def _like_pattern(q):
+    """`%q%`, with LIKE wildcards in `q` escaped."""
+
+    for char in ('\\', '%', '_'):
+        q = q.replace(char, '\\' + char)
+    return f"%{q}%"
+
+
+def _search_fallback(q, offset, limit):
+    # the index holds active users only, so this slices the same results
+    # as _search_postgres's LIMIT and OFFSET
+    ranked = index.search(q)[offset:offset + limit]
+    if not ranked:
+        return []
+
+    found = {user.id: user
+             for user in User.query.filter(User.id.in_(ranked))}
+
+    return [found[user_id] for user_id in ranked if user_id in found]
+
+
+def trigrams(text):
+    """Split `text` into trigrams the way pg_trgm does.
+
+    Each lowercased alphanumeric word is padded with two spaces in front
+    and one behind, so short words and word starts still produce trigrams.
+    """
+
+    grams = set()
+    for word in re.findall(r'\w+', text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NgramIndex:
+    """In-process trigram index over users' search documents.
+
+    Maps each trigram to a compact array of user ids. Deactivated users are
+    left out, so pages are cut from results that will all be shown. Built
+    lazily on the first search and rebuilt after any User is inserted,
+    updated or deleted through the ORM. Bulk loads and updates bypass the
+    ORM and must call invalidate().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = None
+
+    def invalidate(self, *args):
+        self.postings = None
+
+    def build(self):
+        postings = defaultdict(lambda: array('l'))
+        rows = (db.session
+                .query(User.id, User.username, User.bio, User.location)
+                .filter(User.deactivated_at.is_(None))
+                .yield_per(10000))
+
+        for user_id, *fields in rows:
+            document = " ".join(field for field in fields if field)
+            for gram in trigrams(document):
+                postings[gram].append(user_id)
+
+        return dict(postings)
+
+    def search(self, q):
+        """Ids of users sharing at least MIN_SIMILARITY of `q`'s trigrams.
+
+        Sorted best match first, ties broken by id.
+        """
+
+        query_grams = trigrams(q)
+        if not query_grams:
+            return []
+
+        with self.lock:
+            if self.postings is None:
+                self.postings = self.build()
+            postings = self.postings
+
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(postings.get(gram, ()))
+
+        needed = MIN_SIMILARITY * len(query_grams)
+        matches = [(-count, user_id)
+                   for user_id, count in shared.items() if count >= needed]
+        matches.sort()
+
+        return [user_id for _, user_id in matches]
+
+
+index = NgramIndex()
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(User, _event, index.invalidate)
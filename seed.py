@@ -1,20 +1,175 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+Streams each CSV into its table without holding it in memory: PostgreSQL
+gets the file through COPY FROM STDIN, other databases (SQLite) get
+fixed-size executemany() chunks. Secondary indexes are dropped for the load
+and rebuilt afterwards, sequences are reset past any explicit ids, and the
+derived data (user counters, home timelines) is filled in at the end.
+Message rows bring their own snowflake ids (see snowflake.py), made from
+their timestamps, so feeds come out in time order.
+
+    python seed.py [--data-dir generator] [--chunk-size 50000]
+
+A table's data may be split over several files (users.csv, or
+users-0.csv, users-1.csv, ... as written by generator/create_csvs.py
+--shards); they're loaded in name order.
+"""
+
+import argparse
+import csv
+import glob
+import os
+import time
+from datetime import datetime
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+from models import User, Message, Follows, Likes, USER_SEARCH_INDEX_SQL
+import search
+import timeline
+
+# Load order matters: messages, follows and likes point at users.
+TABLES = [User.__table__, Message.__table__, Follows.__table__,
+          Likes.__table__]
+
+# Bytes COPY reads from the file at a time.
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def csv_files(data_dir, table):
+    """The CSV files holding `table`'s rows, in load order."""
+
+    single = os.path.join(data_dir, f"{table.name}.csv")
+    shards = sorted(glob.glob(os.path.join(data_dir, f"{table.name}-*.csv")))
+    return ([single] if os.path.exists(single) else []) + shards
+
+
+def copy_file(path, table):
+    """Stream one CSV file into `table` with PostgreSQL's COPY."""
+
+    with open(path, newline='') as f:
+        columns = next(csv.reader(f))
+        f.seek(0)
+
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) "
+            f"FROM STDIN WITH (FORMAT csv, HEADER true)",
+            f, size=COPY_BUFFER_SIZE)
+
+        return cursor.rowcount
+
+
+def insert_file(path, table, chunk_size):
+    """Load one CSV file into `table` with executemany, a chunk at a time."""
+
+    def coerce(column, value):
+        if value == '':
+            return None
+        if isinstance(column.type, db.DateTime):
+            return datetime.fromisoformat(value)
+        return value
+
+    count = 0
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        columns = [table.c[name] for name in reader.fieldnames]
+
+        while True:
+            chunk = [{column.name: coerce(column, row[column.name])
+                      for column in columns}
+                     for _, row in zip(range(chunk_size), reader)]
+            if not chunk:
+                break
+
+            db.session.execute(table.insert(), chunk)
+            count += len(chunk)
+
+    return count
+
+
+def reset_sequence(table):
+    """Move `table`'s id sequence past any ids loaded explicitly."""
+
+    db.session.execute(
+        f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+        f"coalesce(max(id), 1), max(id) IS NOT NULL) FROM {table.name}")
+
+
+def load(data_dir, chunk_size=50000):
+    """Recreate every table and fill it from the CSVs in `data_dir`.
+
+    Returns the number of CSV rows loaded.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+    postgres = db.engine.dialect.name == 'postgresql'
+    indexes = [index for table in TABLES for index in table.indexes]
+
+    for index in indexes:
+        db.session.execute(f"DROP INDEX {index.name}")
+    if postgres:
+        db.session.execute("DROP INDEX ix_users_search_trgm")
+    db.session.commit()
+
+    started = time.perf_counter()
+    total = 0
+
+    for table in TABLES:
+        for path in csv_files(data_dir, table):
+            start = time.perf_counter()
+            if postgres:
+                count = copy_file(path, table)
+            else:
+                count = insert_file(path, table, chunk_size)
+            db.session.commit()
+
+            elapsed = time.perf_counter() - start
+            total += count
+            print(f"{path}: {count} rows in {elapsed:.1f}s "
+                  f"({count / max(elapsed, 1e-9):,.0f} rows/sec)")
+
+    start = time.perf_counter()
+    for index in indexes:
+        index.create(db.session.connection())
+    if postgres:
+        db.session.execute(USER_SEARCH_INDEX_SQL)
+        for table in TABLES:
+            # message ids are snowflakes, not from a sequence
+            if 'id' in table.c and table.c.id.default is None:
+                reset_sequence(table)
+        db.session.execute("ANALYZE")
+    db.session.commit()
+    print(f"Rebuilt indexes in {time.perf_counter() - start:.1f}s")
+
+    # Fill in counters and materialize home timelines for the data we
+    # just loaded
+
+    start = time.perf_counter()
+    User.reconcile_counts()
+    Message.reconcile_counts()
+    entries = timeline.rebuild()
+    search.index.invalidate()
+    db.session.commit()
+    print(f"Derived counters and {entries} timeline entries "
+          f"in {time.perf_counter() - start:.1f}s")
 
+    elapsed = time.perf_counter() - started
+    print(f"Loaded {total} rows in {elapsed:.1f}s "
+          f"({total / max(elapsed, 1e-9):,.0f} rows/sec overall)")
+    return total
 
-db.drop_all()
-db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+def main():
+    parser = argparse.ArgumentParser(description="Load Warbler CSV data.")
+    parser.add_argument('--data-dir', default='generator')
+    parser.add_argument('--chunk-size', type=int, default=50000,
+                        help="rows per executemany when not using COPY")
+    args = parser.parse_args()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    load(args.data_dir, args.chunk_size)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Time-ordered 64-bit ids ("snowflakes") for messages.
+
+An id packs, from the top bit down:
+
+- 41 bits: milliseconds since EPOCH (enough for 69 years)
+- 10 bits: the worker that made it
+- 12 bits: a sequence number within that millisecond
+
+so ids sort by creation time, and feeds can order and page by the primary
+key alone. Ids are unique as long as no two live processes share a worker
+number. Each process gets one the first time it needs an id (again after
+a fork):
+
+- SNOWFLAKE_WORKER_ID in the app's config, if set. Only for deployments
+  that run one process per value; forked workers would all share it.
+- Otherwise, on PostgreSQL, claim_worker() takes a session advisory lock
+  on the first free number, starting from one derived from the pid, on a
+  connection the process keeps open. Every process using the database
+  gets its own number, and a dead process's number frees up with its
+  connection. At most 1024 processes can make ids at once.
+- Otherwise (SQLite in development and tests, one process) the pid.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+EPOCH = datetime(2010, 1, 1)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+# First key of the advisory locks that hold worker numbers (the second is
+# the number itself).
+WORKER_LOCK_KEY = 0x736e6f77
+
+_EPOCH_SECONDS = (EPOCH - datetime(1970, 1, 1)).total_seconds()
+
+# Connections holding this process's worker lock; never closed.
+_lock_connections = []
+
+
+def make_id(when, worker=0, sequence=0):
+    """The id for a naive UTC datetime `when`, from `worker` and `sequence`.
+
+    For ids made outside the app, e.g. by generator/create_csvs.py.
+    """
+
+    millis = (when - EPOCH) // timedelta(milliseconds=1)
+    return ((millis << TIMESTAMP_SHIFT)
+            | ((worker & MAX_WORKER) << SEQUENCE_BITS)
+            | (sequence & MAX_SEQUENCE))
+
+
+def timestamp_of(id):
+    """When `id` was made (to the millisecond), as a naive UTC datetime."""
+
+    return EPOCH + timedelta(milliseconds=id >> TIMESTAMP_SHIFT)
+
+
+def claim_worker(engine):
+    """Claim a worker number no other live process holds; see above."""
+
+    if engine.dialect.name != 'postgresql':
+        return os.getpid() & MAX_WORKER
+
+    # Taken out of the pool, so the lock lives as long as the process
+    connection = engine.raw_connection()
+    connection.detach()
+    cursor = connection.cursor()
+
+    start = os.getpid()
+    for offset in range(MAX_WORKER + 1):
+        worker = (start + offset) & MAX_WORKER
+        cursor.execute("SELECT pg_try_advisory_lock(%s, %s)",
+                       (WORKER_LOCK_KEY, worker))
+        (locked,) = cursor.fetchone()
+        if locked:
+            # the lock is held by the session; don't sit idle in a
+            # transaction
+            connection.commit()
+            _lock_connections.append(connection)
+            return worker
+
+    connection.close()
+    raise RuntimeError("Every snowflake worker number is taken")
+
+
+class IdGenerator:
+    """Hands out increasing ids for one process."""
+
+    def __init__(self, claim=lambda: os.getpid() & MAX_WORKER):
+        self.lock = threading.Lock()
+        self.claim = claim
+        self.reset()
+
+    def reset(self):
+        """Forget the worker number (claimed again on the next id) and
+        start the sequence over."""
+
+        self.worker = None
+        self.last_millis = -1
+        self.sequence = 0
+
+    def next_id(self):
+        with self.lock:
+            if self.worker is None:
+                self.worker = self.claim()
+
+            millis = int((time.time() - _EPOCH_SECONDS) * 1000)
+
+            # never go back, even if the clock does
+            if millis <= self.last_millis:
+                millis = self.last_millis
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # used up this millisecond; borrow the next one
+                    millis += 1
+            else:
+                self.sequence = 0
+
+            self.last_millis = millis
+            return ((millis << TIMESTAMP_SHIFT)
+                    | (self.worker << SEQUENCE_BITS)
+                    | self.sequence)
+
+
+generator = IdGenerator()
+
+# A forked child (say, a prefork server worker) must not share its
+# parent's worker number and sequence
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=generator.reset)
+
+
+def next_id():
+    """A new id from this process's generator."""
+
+    return generator.next_id()
+
+
+def init_app(app, db):
+    """Take worker numbers from the app's config or database."""
+
+    worker = app.config.get('SNOWFLAKE_WORKER_ID')
+    if worker is not None:
+        generator.claim = lambda: worker & MAX_WORKER
+    else:
+        generator.claim = lambda: claim_worker(db.get_engine(app))
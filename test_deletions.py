@@ -0,0 +1,141 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletions.py
+
+
+import os
+from unittest import TestCase, mock
+from models import (db, User, Message, Follows, Likes, TimelineEntry,
+                    AccountDeletion)
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import deletions
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Run deletions by hand rather than on the worker thread
+
+app.config['DELETION_WORKER'] = False
+
+
+class DeletionTestCase(TestCase):
+    """Test background account deletion."""
+
+    def setUp(self):
+        """Create u1 and u2 following each other, liking each other's posts."""
+
+        AccountDeletion.query.delete()
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.u1 = User(email="u1@test.com", username="u1", password="HASHED_PASSWORD")
+        self.u2 = User(email="u2@test.com", username="u2", password="HASHED_PASSWORD")
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        self.u1.following.append(self.u2)
+        self.u2.following.append(self.u1)
+        self.m1 = [Message(text=f"u1 #{i}", user_id=self.u1.id) for i in range(3)]
+        self.m2 = Message(text="u2", user_id=self.u2.id)
+        db.session.add_all(self.m1 + [self.m2])
+        db.session.commit()
+
+        self.u1.likes.append(self.m2)
+        self.u2.likes.extend(self.m1[:2])
+        timeline.rebuild()
+        User.reconcile_counts()
+        Message.reconcile_counts()
+        db.session.commit()
+
+        self.u1_id = self.u1.id
+        self.u2_id = self.u2.id
+        self.m2_id = self.m2.id
+
+    def tearDown(self):
+        """ Tears down session from bad failed commits """
+
+        db.session.rollback()
+        db.session.remove()
+
+    def test_request_deletion(self):
+        """ Is the user deactivated at once, with their data left for later? """
+
+        deletions.request_deletion(self.u1_id)
+        db.session.commit()
+
+        self.assertIsNotNone(User.query.get(self.u1_id).deactivated_at)
+        self.assertFalse(User.authenticate("u1", "HASHED_PASSWORD"))
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(), 3)
+
+        job = AccountDeletion.query.filter_by(user_id=self.u1_id).one()
+        self.assertEqual(job.phase, 'messages')
+        self.assertIsNone(job.finished_at)
+
+    def test_run_pending(self):
+        """ Does the worker remove everything and fix u2's counters? """
+
+        deletions.request_deletion(self.u1_id)
+        db.session.commit()
+
+        finished = deletions.run_pending()
+        self.assertEqual([job.user_id for job in finished], [self.u1_id])
+
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual((u2.followers_count, u2.following_count, u2.likes_count),
+                         (0, 0, 0))
+        self.assertEqual(Message.query.get(self.m2_id).likes_count, 0)
+
+        # the counters were right all along
+        self.assertEqual(User.reconcile_counts(), 0)
+        self.assertEqual(Message.reconcile_counts(), 0)
+
+        job = AccountDeletion.query.filter_by(user_id=self.u1_id).one()
+        self.assertEqual(job.phase, 'user')
+        self.assertIsNotNone(job.finished_at)
+        # 3 messages, 1 like, 1 follow each way, 1 timeline entry, the user
+        self.assertEqual(job.rows_deleted, 8)
+
+    def test_batches(self):
+        """ Does each batch commit progress and stay within BATCH_SIZE? """
+
+        deletions.request_deletion(self.u1_id)
+        db.session.commit()
+
+        with mock.patch('deletions.BATCH_SIZE', 2):
+            job = deletions.run_batch()
+            self.assertEqual((job.phase, job.rows_deleted), ('messages', 2))
+            self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(), 1)
+
+            job = deletions.run_batch()
+            self.assertEqual((job.phase, job.rows_deleted), ('likes', 3))
+
+            deletions.run_pending()
+
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertIsNone(deletions.run_batch())
@@ -0,0 +1,121 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_http_cache.py
+
+
+import os
+from unittest import TestCase
+from models import db, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class HttpCacheTestCase(TestCase):
+    """Test per-route cache headers."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User(email="test@test.com", username="testuser", password="HASHED_PASSWORD")
+        db.session.add(self.testuser)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+    def test_profile_etag(self):
+        """ Do logged-out profile views revalidate with an ETag? """
+
+        url = f"/users/{self.testuser_id}"
+
+        resp = self.client.get(url)
+        etag = resp.headers['ETag']
+        self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.get_data(), b"")
+
+        db.session.add(Message(text="New warble", user_id=self.testuser_id))
+        db.session.commit()
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertIn("New warble", resp.get_data(as_text=True))
+
+    def test_message_etag_follows_author_profile(self):
+        """ Does editing the author's profile change a message's ETag? """
+
+        msg = Message(text="Hello", user_id=self.testuser_id)
+        db.session.add(msg)
+        db.session.commit()
+        url = f"/messages/{msg.id}"
+
+        etag = self.client.get(url).headers['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+
+        User.query.filter_by(id=self.testuser_id).update(
+            {'username': 'renamed', 'profile_version': User.profile_version + 1})
+        db.session.commit()
+
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@renamed", resp.get_data(as_text=True))
+
+    def test_logged_in_not_stored(self):
+        """ Are personalized pages kept out of caches? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get(f"/users/{self.testuser_id}")
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-store')
+            self.assertNotIn('ETag', resp.headers)
+
+    def test_static_fingerprint(self):
+        """ Are fingerprinted static URLs cached as immutable? """
+
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn('/static/stylesheets/style.css?v=', html)
+
+        with app.test_request_context():
+            from http_cache import static_url
+            url = static_url('stylesheets/style.css')
+
+        resp = self.client.get(url)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+
+        resp = self.client.get("/static/stylesheets/style.css")
+        self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+
+        # a hash that isn't the file's current one
+        resp = self.client.get("/static/stylesheets/style.css?v=0123456789ab")
+        self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
+
+        resp = self.client.get("/static/no-such-file.css?v=0123456789ab")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.headers['Cache-Control'], 'public, no-cache')
@@ -0,0 +1,129 @@
+"""Instrumentation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_instrumentation.py
+
+
+import os
+from unittest import TestCase, mock
+from sqlalchemy import exc
+from models import db, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import instrumentation
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class InstrumentationTestCase(TestCase):
+    """Test per-request metrics."""
+
+    def setUp(self):
+        """Create test client, add sample data, reset metrics."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.client = app.test_client()
+
+        self.testuser = User(email="test@test.com", username="testuser", password="HASHED_PASSWORD")
+        db.session.add(self.testuser)
+        db.session.commit()
+
+        instrumentation.registry.reset()
+
+    def test_metrics_endpoint(self):
+        """ Are per-endpoint counts exposed in Prometheus format? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get(f"/users/{self.testuser.id}")
+            c.get(f"/users/{self.testuser.id}")
+
+            with mock.patch.dict(app.config, METRICS_TOKEN="s3cret"):
+                resp = c.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.content_type.startswith("text/plain"))
+            text = resp.get_data(as_text=True)
+            self.assertIn('# TYPE warbler_requests_total counter', text)
+            self.assertIn('warbler_requests_total{endpoint="users_show"} 2', text)
+            self.assertIn('warbler_db_queries_total{endpoint="users_show"}', text)
+            self.assertIn('warbler_template_seconds_total{endpoint="users_show"}', text)
+
+    def test_query_count_recorded(self):
+        """ Does the registry count the statements a request ran? """
+
+        id = self.testuser.id
+
+        with instrumentation.count_queries() as queries:
+            self.client.get(f"/users/{ id }")
+
+        totals = instrumentation.registry.endpoints['users_show']
+        self.assertEqual(totals['requests_total'], 1)
+        self.assertEqual(totals['db_queries_total'], queries.count)
+
+    def test_init_app_once(self):
+        """ Does a second init_app() leave requests counted (and timed) once? """
+
+        instrumentation.init_app(app)
+        self.client.get(f"/users/{ self.testuser.id }")
+
+        totals = instrumentation.registry.endpoints['users_show']
+        self.assertEqual(totals['requests_total'], 1)
+        self.assertGreater(totals['template_seconds_total'], 0)
+
+    def test_slow_queries_sampled(self):
+        """ Are statements over the threshold kept as samples? """
+
+        threshold = instrumentation.SLOW_QUERY_SECONDS
+        instrumentation.SLOW_QUERY_SECONDS = 0
+        try:
+            self.client.get(f"/users/{self.testuser.id}")
+        finally:
+            instrumentation.SLOW_QUERY_SECONDS = threshold
+
+        self.assertTrue(instrumentation.registry.slow_queries)
+        text = instrumentation.registry.render()
+        self.assertIn('warbler_slow_query_seconds{endpoint="users_show",query="', text)
+        # the SQL itself stays out of the exposition
+        self.assertNotIn('SELECT', text)
+
+    def test_metrics_need_token(self):
+        """ Is /metrics hidden without a token and refused with a wrong one? """
+
+        with mock.patch.dict(app.config, METRICS_TOKEN=None):
+            self.assertEqual(self.client.get("/metrics").status_code, 404)
+
+        with mock.patch.dict(app.config, METRICS_TOKEN="s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            resp = self.client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+            self.assertEqual(resp.status_code, 403)
+
+    def test_failed_statement_leaves_no_timing(self):
+        """ Does a statement that raises leave no timing state on the connection? """
+
+        with db.engine.connect() as conn:
+            with self.assertRaises(exc.DBAPIError):
+                conn.execute("SELECT * FROM no_such_table")
+            self.assertNotIn('query_start', conn.info)
+
+            with instrumentation.count_queries() as queries:
+                conn.execute("SELECT 1")
+            self.assertEqual(queries.count, 1)
@@ -6,6 +6,7 @@
 
 
 import os
+import time
 from unittest import TestCase
 from sqlalchemy import exc
 from models import db, connect_db, Message, User
@@ -21,6 +22,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from passwords import hasher, HashingBusy
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -126,4 +128,72 @@ class LoginViewTestCase(TestCase):
         resp = c.get("/logout", follow_redirects=True)
         self.assertEqual(resp.status_code, 200)
         html = resp.get_data(as_text=True)
-        self.assertNotIn('<p class="small">Messages</p>', html)
\ No newline at end of file
+        self.assertNotIn('<p class="small">Messages</p>', html)
+
+
+    def test_login_rehashes_password(self):
+        """ Is a hash made at an old work factor upgraded on login? """
+
+        c = self.client
+        c.post("/signup", data={"username": "testuser", "email": "test@test.com", "password": "123456"})
+        u = User.query.filter(User.username=="testuser").one()
+        rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            u.password = hasher.hash("123456")
+            db.session.commit()
+        finally:
+            hasher.rounds = rounds
+
+        c.get("/logout")
+        resp = c.post("/login", data={"username": "testuser", "password": "123456"})
+        self.assertEqual(resp.status_code, 302)
+        u = User.query.filter(User.username=="testuser").one()
+        self.assertTrue(u.password.startswith(f"$2b${rounds}$"))
+
+
+    def test_login_busy(self):
+        """ Do logins get a 429 when the hashing pool is saturated? """
+
+        self.client.post("/signup", data={"username": "testuser", "email": "test@test.com", "password": "123456"})
+        self.client.get("/logout")
+
+        workers = hasher.workers
+        hasher.workers = 1
+        taken = 0
+        while hasher.pending.acquire(blocking=False):
+            taken += 1
+        try:
+            resp = self.client.post("/login", data={"username": "testuser", "password": "123456"})
+        finally:
+            for _ in range(taken):
+                hasher.pending.release()
+            hasher.workers = workers
+
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+
+
+    def test_hashing_timeout_and_broken_pool(self):
+        """ Are slow hashes and a crashed pool refused, and the pool replaced? """
+
+        settings = (hasher.workers, hasher.timeout)
+        hasher.workers, hasher.timeout = 1, 0.01
+        try:
+            with self.assertRaises(HashingBusy):
+                hasher._run(time.sleep, 1)
+
+            hasher.timeout = 10
+            with self.assertRaises(HashingBusy):
+                hasher._run(os._exit, 1)
+
+            self.assertIsNone(hasher.pool)
+            self.assertTrue(hasher.check(hasher.hash("123456"), "123456"))
+
+            # a discarded pool leaves no processes behind
+            processes = list(hasher.pool._processes.values())
+            hasher._discard(hasher.pool)
+            self.assertFalse(any(process.is_alive() for process in processes))
+        finally:
+            hasher._discard(hasher.pool)
+            hasher.workers, hasher.timeout = settings
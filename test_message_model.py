@@ -6,10 +6,11 @@
 
 
 import os
-from unittest import TestCase
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
 from sqlalchemy import exc
 import sqlalchemy
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -22,6 +23,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+import snowflake
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -93,4 +95,91 @@ class MessageModelTestCase(TestCase):
         db.session.add(m)
         db.session.commit()
 
-        self.assertIn(m, u.messages)
\ No newline at end of file
+        self.assertIn(m, u.messages)
+
+
+    def test_message_likes(self):
+        """ Can several users like the same message, once each? """
+
+        u1 = User.signup("testuser1", "test1@test.com", "123456", "/static/images/default-pic.png")
+        u2 = User.signup("testuser2", "test2@test.com", "123456", "/static/images/default-pic.png")
+        m = Message(text="Popular", user=u1)
+        db.session.add(m)
+        db.session.commit()
+
+        self.assertEqual(Likes.toggle(u1.id, m.id), 1)
+        self.assertEqual(Likes.toggle(u2.id, m.id), 1)
+        db.session.commit()
+        self.assertEqual((m.likes_count, u1.likes_count, u2.likes_count), (2, 1, 1))
+
+        self.assertEqual(Likes.toggle(u1.id, m.id), -1)
+        db.session.commit()
+        self.assertEqual((m.likes_count, u1.likes_count), (1, 0))
+        self.assertEqual(Likes.query.one().user_id, u2.id)
+
+        self.assertIsNone(Likes.toggle(u1.id, m.id + 1))
+
+        db.session.add(Likes(user_id=u2.id, message_id=m.id))
+        with self.assertRaises(exc.IntegrityError):
+            db.session.commit()
+
+
+    def test_message_reconcile_counts(self):
+        """ Does reconcile_counts repair like counts that drifted? """
+
+        u = User.signup("testuser", "test@test.com", "123456", "/static/images/default-pic.png")
+        m1 = Message(text="Liked", user=u)
+        m2 = Message(text="Not liked", user=u, likes_count=3)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+        db.session.add(Likes(user_id=u.id, message_id=m1.id))
+        db.session.commit()
+
+        self.assertEqual(Message.reconcile_counts(), 2)
+        db.session.commit()
+        self.assertEqual((m1.likes_count, m2.likes_count), (1, 0))
+        self.assertEqual(Message.reconcile_counts(), 0)
+
+
+    def test_message_ids_and_timestamps(self):
+        """ Do new messages get time-ordered ids and the database's time? """
+
+        # before any database work, which opens the transaction
+        before = datetime.utcnow().replace(microsecond=0)
+        u = User.signup("testuser", "test@test.com", "123456", "/static/images/default-pic.png")
+        m1 = Message(text="First", user=u)
+        db.session.add(m1)
+        db.session.commit()
+        m2 = Message(text="Second", user=u)
+        db.session.add(m2)
+        db.session.commit()
+
+        self.assertLess(m1.id, m2.id)
+        self.assertGreater(m1.id, 2 ** 32)
+        self.assertLess(abs(snowflake.timestamp_of(m2.id) - before), timedelta(minutes=1))
+
+        # set by the database, not fixed when the module was imported
+        self.assertGreaterEqual(m1.timestamp, before)
+        self.assertLess(m2.timestamp - before, timedelta(minutes=1))
+
+
+    def test_snowflake_ids(self):
+        """ Do snowflakes round-trip their time and keep increasing? """
+
+        when = datetime(2020, 5, 17, 12, 30, 15, 250000)
+        id = snowflake.make_id(when, worker=3, sequence=7)
+        self.assertEqual(snowflake.timestamp_of(id), when)
+        self.assertLess(id, snowflake.make_id(when + timedelta(milliseconds=1)))
+
+        generator = snowflake.IdGenerator()
+        ids = [generator.next_id() for _ in range(10000)]
+        self.assertEqual(ids, sorted(set(ids)))
+
+
+    @skipUnless(db.engine.dialect.name == 'postgresql', "advisory locks")
+    def test_snowflake_workers_unique(self):
+        """ Do processes sharing the database get different worker numbers? """
+
+        # each claim is another session, as another process would have
+        workers = {snowflake.claim_worker(db.engine) for _ in range(3)}
+        self.assertEqual(len(workers), 3)
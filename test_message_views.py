@@ -9,6 +9,8 @@ import os
 from unittest import TestCase
 from sqlalchemy import exc
 from models import db, connect_db, Message, User
+from instrumentation import assert_max_queries, count_queries
+import fragments
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -142,4 +144,106 @@ class MessageViewTestCase(TestCase):
             # Make sure it redirects
             self.assertEqual(resp.status_code, 200)
             self.assertEqual([], Message.query.all())
-            self.assertNotIn("Hello", html)
\ No newline at end of file
+            self.assertNotIn("Hello", html)
+
+
+    def test_delete_someone_elses_message(self):
+        """Is deleting another user's message refused?"""
+
+        other = User(email="other@test.com", username="other", password="HASHED_PASSWORD")
+        msg = Message(text="Not yours", user=other)
+        db.session.add_all([other, msg])
+        db.session.commit()
+        id = msg.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/messages/{id}/delete")
+            self.assertEqual(resp.location, "http://localhost/")
+            self.assertIsNotNone(Message.query.get(id))
+
+
+    def test_bulk_delete_messages(self):
+        """Can you delete many of your own messages at once, and only those?"""
+
+        other = User(email="other@test.com", username="other", password="HASHED_PASSWORD")
+        mine = [Message(text=f"Mine {i}", user=self.testuser) for i in range(3)]
+        theirs = Message(text="Theirs", user=other)
+        db.session.add_all([other, theirs] + mine)
+        db.session.commit()
+        other.likes.append(mine[0])
+        other.likes_count = 1
+        self.testuser.messages_count = 3
+        db.session.commit()
+        other_id, theirs_id = other.id, theirs.id
+        mine_ids = [m.id for m in mine]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/messages/delete", json={"message_ids": mine_ids[:2] + [theirs_id]})
+            self.assertEqual(resp.get_json(), {"deleted": [str(id) for id in mine_ids[:2]]})
+
+            # a bare list, a string of digits or an id past BIGINT: 400
+            for body in (mine_ids[2:], {"message_ids": str(mine_ids[2])},
+                         {"message_ids": [2 ** 63]}):
+                resp = c.post("/messages/delete", json=body)
+                self.assertEqual(resp.status_code, 400)
+
+        self.assertEqual([m.id for m in Message.query.order_by(Message.id)],
+                         sorted([theirs_id, mine_ids[2]]))
+        self.assertEqual(User.query.get(self.testuser.id).messages_count, 1)
+        self.assertEqual(User.query.get(other_id).likes_count, 0)
+
+
+    def test_add_message_skips_history(self):
+        """Does posting leave the author's earlier messages unloaded?"""
+
+        db.session.add_all([Message(text=f"Old {i}", user_id=self.testuser.id) for i in range(3)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with count_queries() as queries:
+                c.post("/messages/new", data={"text": "Hello"})
+
+        self.assertEqual(Message.query.count(), 4)
+        self.assertFalse([statement for statement in queries.statements
+                          if statement.lstrip().startswith("SELECT")
+                          and "FROM messages" in statement])
+
+
+    def test_show_message_query_count(self):
+        """Does showing a message load its author in the same query?"""
+
+        msg = Message(text="Hello", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+        id = msg.id
+
+        with assert_max_queries(1):
+            resp = self.client.get(f"/messages/{ id }")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@testuser", resp.get_data(as_text=True))
+
+
+    def test_delete_message_drops_fragment(self):
+        """Does deleting a message drop its cached feed row?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello"})
+            id = Message.query.one().id
+            c.get(f"/users/{self.testuser.id}")
+            self.assertIsNotNone(fragments.cache.entries.get(id))
+
+            c.post(f"/messages/{id}/delete")
+            self.assertIsNone(fragments.cache.entries.get(id))
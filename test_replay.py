@@ -0,0 +1,87 @@
+"""Request log replay tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_replay.py
+
+
+import os
+from unittest import TestCase
+from models import db, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+from benchmarks import replay
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+replay.instrument(app)
+
+
+class ReplayTestCase(TestCase):
+    """Test replaying request logs."""
+
+    def setUp(self):
+        """Add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+
+        self.testuser = User(email="test@test.com", username="testuser", password="HASHED_PASSWORD")
+        db.session.add(self.testuser)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+    def test_replay_report(self):
+        """ Are requests grouped by route, with queries and errors counted? """
+
+        entries = [
+            {"method": "GET", "path": f"/users/{self.testuser_id}"},
+            {"method": "GET", "path": f"/users/{self.testuser_id}"},
+            {"method": "GET", "path": "/messages/new", "user_id": self.testuser_id},
+            {"method": "POST", "path": "/messages/new", "user_id": self.testuser_id,
+             "form": {"text": "replayed"}},
+        ]
+
+        results, elapsed = replay.replay(app, entries, replay.TestClientTarget(app))
+        report = replay.report(results, elapsed)
+
+        self.assertEqual(report['requests'], 4)
+        self.assertEqual(report['routes']['GET users_show']['count'], 2)
+        self.assertGreater(report['routes']['GET users_show']['queries_mean'], 0)
+        self.assertEqual(report['routes']['ALL']['error_rate'], 0)
+
+        # Logged in, so the form rendered and the message was posted
+        self.assertEqual([r['status'] for r in results[2:]], [200, 302])
+        self.assertEqual(Message.query.one().text, "replayed")
+
+    def test_compare(self):
+        """ Does compare flag routes that got slower past the threshold? """
+
+        old = {'routes': {'GET homepage': {'p95_ms': 10.0, 'error_rate': 0.0},
+                          'GET users_show': {'p95_ms': 10.0, 'error_rate': 0.0}}}
+        new = {'routes': {'GET homepage': {'p95_ms': 10.5, 'error_rate': 0.0},
+                          'GET users_show': {'p95_ms': 15.0, 'error_rate': 0.0}}}
+
+        lines, regressions = replay.compare(old, new, threshold=0.1)
+
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('GET users_show', regressions[0])
@@ -0,0 +1,111 @@
+"""Seed loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+
+
+import csv
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+from models import db, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import seed
+import snowflake
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+def write_csv(directory, name, rows):
+    with open(os.path.join(directory, name), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+class SeedTestCase(TestCase):
+    """Test loading CSVs with seed.py."""
+
+    def setUp(self):
+        """Write three users (over two shards), their messages, follows and likes."""
+
+        db.session.commit()
+        db.session.remove()
+
+        self.data_dir = tempfile.TemporaryDirectory()
+        users = [dict(id=i, email=f"u{i}@test.com", username=f"u{i}",
+                      image_url="/static/images/default-pic.png",
+                      password="HASHED_PASSWORD", bio="", location="",
+                      header_image_url="/static/images/warbler-hero.jpg")
+                 for i in (1, 2, 3)]
+        write_csv(self.data_dir.name, "users-0.csv", users[:2])
+        write_csv(self.data_dir.name, "users-1.csv", users[2:])
+
+        start = datetime(2020, 1, 1)
+        self.message_ids = [snowflake.make_id(start + timedelta(hours=i)) for i in range(4)]
+        write_csv(self.data_dir.name, "messages.csv", [
+            dict(id=id, text=f"Warble {i}", timestamp=start + timedelta(hours=i),
+                 user_id=1 if i < 3 else 2)
+            for i, id in enumerate(self.message_ids)])
+
+        # 2 and 3 follow 1; 3 follows 2
+        write_csv(self.data_dir.name, "follows.csv", [
+            dict(user_being_followed_id=1, user_following_id=2),
+            dict(user_being_followed_id=1, user_following_id=3),
+            dict(user_being_followed_id=2, user_following_id=3)])
+
+        write_csv(self.data_dir.name, "likes.csv", [
+            dict(user_id=2, message_id=self.message_ids[0]),
+            dict(user_id=3, message_id=self.message_ids[0])])
+
+    def tearDown(self):
+        """ Tears down session from bad failed commits """
+
+        self.data_dir.cleanup()
+        db.session.rollback()
+        db.session.remove()
+
+    def test_load(self):
+        """ Are rows, counters, timelines, indexes and sequences all in place? """
+
+        with app.app_context():
+            self.assertEqual(seed.load(self.data_dir.name), 3 + 4 + 3 + 2)
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual([m.id for m in Message.query.order_by(Message.id)], self.message_ids)
+
+        counts = {u.id: (u.messages_count, u.followers_count, u.following_count, u.likes_count)
+                  for u in User.query}
+        self.assertEqual(counts, {1: (3, 2, 0, 0), 2: (1, 1, 1, 1), 3: (0, 0, 2, 1)})
+        self.assertEqual(Message.query.get(self.message_ids[0]).likes_count, 2)
+
+        # 2 sees 1's three messages; 3 sees those and 2's one
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=2).count(), 3)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=3).count(), 4)
+
+        indexes = {index['name'] for index in db.inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_id', indexes)
+
+        # new users get ids past the ones loaded
+        u = User(email="new@test.com", username="new", password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.commit()
+        self.assertEqual(u.id, 4)
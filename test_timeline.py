@@ -0,0 +1,166 @@
+"""Timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+from models import db, User, Message, Follows, TimelineEntry
+from instrumentation import assert_max_queries
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app  # noqa: F401 (sets up the database)
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out-on-write timelines."""
+
+    def setUp(self):
+        """Create two users, u1 following u2."""
+
+        TimelineEntry.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.u1 = User(email="u1@test.com", username="u1", password="HASHED_PASSWORD")
+        self.u2 = User(email="u2@test.com", username="u2", password="HASHED_PASSWORD")
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        self.u1.following.append(self.u2)
+        User.reconcile_counts()
+        db.session.commit()
+
+    def tearDown(self):
+        """ Tears down session from bad failed commits """
+
+        db.session.rollback()
+        db.session.remove()
+
+    def post(self, user, text):
+        msg = Message(text=text, user_id=user.id)
+        db.session.add(msg)
+        db.session.flush()
+        timeline.fan_out(msg)
+        db.session.commit()
+        return msg
+
+    def test_fan_out(self):
+        """ Does posting push the message into followers' feeds only? """
+
+        msg = self.post(self.u2, "hello followers")
+
+        self.assertEqual(timeline.feed(self.u1.id), [msg])
+        self.assertEqual(timeline.feed(self.u2.id), [])
+
+    def test_retract(self):
+        """ Does deleting a message remove it from feeds? """
+
+        msg = self.post(self.u2, "oops")
+        timeline.retract(msg.id)
+        db.session.commit()
+
+        self.assertEqual(timeline.feed(self.u1.id), [])
+
+    def test_backfill_and_unfill(self):
+        """ Does following copy old messages in, and unfollowing take them out? """
+
+        msg = self.post(self.u1, "from before")
+        timeline.backfill(self.u2.id, self.u1.id)
+        db.session.commit()
+        self.assertEqual(timeline.feed(self.u2.id), [msg])
+
+        timeline.unfill(self.u2.id, self.u1.id)
+        db.session.commit()
+        self.assertEqual(timeline.feed(self.u2.id), [])
+
+    def test_backfill_many(self):
+        """ Does one backfill copy in the newest few messages of each author? """
+
+        u3 = User(email="u3@test.com", username="u3", password="HASHED_PASSWORD")
+        db.session.add(u3)
+        db.session.commit()
+
+        old = [self.post(self.u1, f"u1 #{i}") for i in range(3)]
+        other = self.post(u3, "u3")
+        timeline.backfill(self.u2.id, [self.u1.id, u3.id], limit=2)
+        db.session.commit()
+        self.assertEqual(timeline.feed(self.u2.id), [other, old[2], old[1]])
+
+    def test_rebuild(self):
+        """ Does rebuild recreate feeds from follows and messages? """
+
+        msg = Message(text="not fanned out", user_id=self.u2.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertEqual(timeline.feed(self.u1.id), [])
+
+        timeline.rebuild()
+        db.session.commit()
+        self.assertEqual(timeline.feed(self.u1.id), [msg])
+
+    def test_celebrity_pulled_at_read_time(self):
+        """ Are messages from authors over the threshold merged in on read? """
+
+        threshold = timeline.FANOUT_THRESHOLD
+        timeline.FANOUT_THRESHOLD = 1
+        try:
+            older = Message(text="pushed earlier", user_id=self.u2.id)
+            db.session.add(older)
+            db.session.flush()
+            db.session.add(TimelineEntry(user_id=self.u1.id, message_id=older.id,
+                                         author_id=self.u2.id))
+            db.session.commit()
+
+            msg = self.post(self.u2, "too famous to fan out")
+
+            self.assertEqual(TimelineEntry.query.filter_by(message_id=msg.id).count(), 0)
+            self.assertEqual({m.id for m in timeline.feed(self.u1.id)}, {older.id, msg.id})
+            self.assertEqual(len(timeline.feed(self.u1.id)), 2)
+        finally:
+            timeline.FANOUT_THRESHOLD = threshold
+
+    def test_celebrities_pulled_in_one_query(self):
+        """ Does following more celebrities leave the query count alone? """
+
+        threshold = timeline.FANOUT_THRESHOLD
+        timeline.FANOUT_THRESHOLD = 1
+        try:
+            stars = [User(email=f"star{i}@test.com", username=f"star{i}", password="HASHED_PASSWORD")
+                     for i in range(5)]
+            db.session.add_all(stars)
+            db.session.commit()
+            for star in stars:
+                self.u1.following.append(star)
+                star.following.append(self.u2)
+            User.reconcile_counts()
+            db.session.commit()
+            posted = [self.post(star, f"from {star.username}").id for star in stars]
+            u1_id = self.u1.id
+
+            # followed celebrities, pushed entries, pulled messages
+            with assert_max_queries(3):
+                feed = timeline.feed(u1_id, limit=4)
+
+            self.assertEqual([msg.id for msg in feed], posted[::-1][:4])
+        finally:
+            timeline.FANOUT_THRESHOLD = threshold
@@ -145,6 +145,58 @@ class UserModelTestCase(TestCase):
         self.assertFalse(u2.is_followed_by(u1))
 
 
+    def test_user_following_ids(self):
+        """ Does following_ids return just the followed users out of a batch? """
+
+        User.signup("testuser1", "test1@test.com", "123456", "/static/images/default-pic.png")
+        User.signup("testuser2", "test2@test.com", "123456", "/static/images/default-pic.png")
+        User.signup("testuser3", "test3@test.com", "123456", "/static/images/default-pic.png")
+        u1 = User.query.filter(User.username=="testuser1").one()
+        u2 = User.query.filter(User.username=="testuser2").one()
+        u3 = User.query.filter(User.username=="testuser3").one()
+        u1.following.append(u2)
+
+        self.assertEqual(u1.following_ids([u1.id, u2.id, u3.id]), {u2.id})
+        self.assertEqual(u2.following_ids([u1.id, u3.id]), set())
+        self.assertEqual(u1.following_ids([]), set())
+
+
+    def test_user_liked_ids(self):
+        """ Does liked_ids return just the liked messages out of a batch? """
+
+        User.signup("testuser1", "test1@test.com", "123456", "/static/images/default-pic.png")
+        u1 = User.query.filter(User.username=="testuser1").one()
+        m1 = Message(text="liked", user=u1)
+        m2 = Message(text="not liked", user=u1)
+        db.session.add_all([m1, m2])
+        u1.likes.append(m1)
+        db.session.commit()
+
+        self.assertEqual(u1.liked_ids([m1.id, m2.id]), {m1.id})
+        self.assertEqual(u1.liked_ids([m2.id]), set())
+        self.assertEqual(u1.liked_ids([]), set())
+
+
+    def test_user_reconcile_counts(self):
+        """ Does reconcile_counts repair counters that drifted? """
+
+        User.signup("testuser1", "test1@test.com", "123456", "/static/images/default-pic.png")
+        User.signup("testuser2", "test2@test.com", "123456", "/static/images/default-pic.png")
+        u1 = User.query.filter(User.username=="testuser1").one()
+        u2 = User.query.filter(User.username=="testuser2").one()
+        u1.following.append(u2)
+        u1.messages.append(Message(text="counted"))
+        u2.likes_count = 5
+        db.session.commit()
+
+        self.assertEqual(User.reconcile_counts(), 2)
+        db.session.commit()
+
+        self.assertEqual((u1.messages_count, u1.following_count, u1.followers_count), (1, 1, 0))
+        self.assertEqual((u2.followers_count, u2.likes_count), (1, 0))
+        self.assertEqual(User.reconcile_counts(), 0)
+
+
     def test_user_authenticate(self):
         """ Does User.authenticate successfully return a user when given a valid username and password? """
 
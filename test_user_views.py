@@ -6,9 +6,11 @@
 
 
 import os
-from unittest import TestCase
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
 from sqlalchemy import exc
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, TimelineEntry
+from instrumentation import assert_max_queries
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +23,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import deletions
+import fragments
+import snowflake
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +37,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run account deletions by hand rather than on the worker thread
+
+app.config['DELETION_WORKER'] = False
+
 
 class UserViewTestCase(TestCase):
     """Test views for users."""
@@ -63,6 +72,21 @@ class UserViewTestCase(TestCase):
             self.assertIn("<p>@testuser</p>", html)
 
 
+    def test_users_follow_buttons(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            u2 = User.signup("testuser2", "test2@test.com", "123456", "/static/images/default-pic.png")
+            db.session.commit()
+            id = u2.id
+            c.post(f"/users/follow/{ id }")
+
+            resp = c.get("/users")
+            html = resp.get_data(as_text=True)
+            self.assertIn(f'action="/users/stop-following/{ id }"', html)
+            self.assertNotIn(f'action="/users/follow/{ id }"', html)
+
+
     def test_user_profile(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -141,6 +165,83 @@ class UserViewTestCase(TestCase):
             self.assertNotIn(f'<p>@{ name }</p>', html)
 
 
+    def test_follow_unknown_and_repeated(self):
+        """ Do follow/unfollow 404 on unknown users and ignore repeats? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            u2 = User.signup("testuser2", "test2@test.com", "123456", "/static/images/default-pic.png")
+            db.session.commit()
+            id, u2_id = self.testuser.id, u2.id
+
+            self.assertEqual(c.post("/users/follow/0").status_code, 404)
+            self.assertEqual(c.post("/users/stop-following/0").status_code, 404)
+
+            resp = c.post(f"/users/stop-following/{u2_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(u2_id).followers_count, 0)
+
+            c.post(f"/users/follow/{u2_id}")
+            c.post(f"/users/follow/{u2_id}")
+            self.assertEqual(User.query.get(u2_id).followers_count, 1)
+            self.assertEqual(c.post(f"/users/follow/{id}").status_code, 302)
+            self.assertEqual(User.query.get(id).following_count, 1)
+
+
+    def test_bulk_follow(self):
+        """ Can a user follow several users in one request? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            others = [User(email=f"bulk{i}@test.com", username=f"bulk{i}", password="HASHED_PASSWORD")
+                      for i in range(3)]
+            db.session.add_all(others)
+            db.session.commit()
+            id = self.testuser.id
+            ids = [u.id for u in others]
+
+            c.post(f"/users/follow/{ids[0]}")
+            resp = c.post("/users/follow", json={"user_ids": ids + [id, 0]})
+            self.assertEqual(resp.get_json(), {"followed": ids[1:]})
+            self.assertEqual(User.query.get(id).following_count, 3)
+            self.assertEqual([User.query.get(i).followers_count for i in ids], [1, 1, 1])
+
+            resp = c.post("/users/follow", data={"user_ids": ["x"]})
+            self.assertEqual(resp.status_code, 400)
+
+            # only a list of ids that fit the column will do
+            for body in ([ids[1]], {"user_ids": str(ids[1])},
+                         {"user_ids": [True]}, {"user_ids": [2 ** 40]}):
+                resp = c.post("/users/follow", json=body)
+                self.assertEqual(resp.status_code, 400)
+
+
+    def test_bulk_follow_queries(self):
+        """ Does a bulk follow take the same few statements however many are followed? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            others = [User(email=f"bulk{i}@test.com", username=f"bulk{i}", password="HASHED_PASSWORD")
+                      for i in range(10)]
+            db.session.add_all(others)
+            db.session.commit()
+            ids = [u.id for u in others]
+            db.session.add_all([Message(text=f"Warble {i}", user_id=user_id)
+                                for user_id in ids for i in range(3)])
+            db.session.commit()
+            c.get("/messages/new")
+
+            with assert_max_queries(7):
+                resp = c.post("/users/follow", json={"user_ids": ids})
+            self.assertEqual(sorted(resp.get_json()["followed"]), ids)
+
+            feed = TimelineEntry.query.filter_by(user_id=self.testuser.id).count()
+            self.assertEqual(feed, 30)
+
+
     def test_user_delete(self):
         with self.client as c:
             with c.session_transaction() as sess:
@@ -148,5 +249,371 @@ class UserViewTestCase(TestCase):
             resp = c.post("/users/delete")
             self.assertEqual(resp.status_code, 302)
             self.assertEqual(resp.location, "http://localhost/signup")
+
+            # gone from the site at once, deleted by the worker later
+            self.assertIsNotNone(User.query.get(self.testuser.id).deactivated_at)
+            self.assertEqual(c.get(f"/users/{self.testuser.id}").status_code, 404)
+            self.assertNotIn("@testuser", c.get("/users").get_data(as_text=True))
+
+            deletions.run_pending()
             self.assertEqual([], User.query.all())
 
+
+
+    def test_user_delete_other_sessions(self):
+        """ Is a session in another browser refused once the account is deleted? """
+
+        other = app.test_client()
+        with other.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+        other.get("/messages/new")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.post("/users/delete")
+
+        resp = other.post("/messages/new", data={"text": "Still here?"})
+        self.assertEqual(resp.location, "http://localhost/")
+        self.assertEqual(Message.query.count(), 0)
+
+        # and logged out
+        with other.session_transaction() as sess:
+            self.assertNotIn(CURR_USER_KEY, sess)
+
+
+
+    def test_home_shows_followed_messages(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            u2 = User.signup("testuser2", "test2@test.com", "123456", "/static/images/default-pic.png")
+            db.session.commit()
+            db.session.add(Message(text="Warble from u2", user_id=u2.id))
+            db.session.commit()
+            c.post(f"/users/follow/{u2.id}")
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Warble from u2", html)
+
+
+    def test_user_profile_pagination(self):
+        with self.client as c:
+            start = datetime(2020, 1, 1)
+            ids = [snowflake.make_id(start + timedelta(days=i)) for i in range(3)]
+            for i, id in enumerate(ids):
+                db.session.add(Message(id=id, text=f"Warble {i}", user_id=self.testuser.id,
+                                       timestamp=start + timedelta(days=i)))
+            db.session.commit()
+
+            with mock.patch('app.MESSAGES_PER_PAGE', 2):
+                resp = c.get(f"/users/{self.testuser.id}")
+                html = resp.get_data(as_text=True)
+                self.assertIn("Warble 2", html)
+                self.assertIn("Warble 1", html)
+                self.assertNotIn("Warble 0", html)
+                self.assertIn("Older messages", html)
+
+                resp = c.get(f"/users/{self.testuser.id}?before={ids[2]}")
+                html = resp.get_data(as_text=True)
+                self.assertNotIn("Warble 2", html)
+                self.assertIn("Warble 1", html)
+                self.assertIn("Warble 0", html)
+                self.assertNotIn("Older messages", html)
+
+
+    def test_user_likes(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            msg = Message(text="Likeable warble", user_id=self.testuser.id)
+            db.session.add(msg)
+            db.session.commit()
+            c.post(f"/messages/{msg.id}/like")
+            resp = c.get(f"/users/{self.testuser.id}/likes")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Likeable warble", resp.get_data(as_text=True))
+
+
+    def test_toggle_like_shared_message(self):
+        """ Can two users like one message, and unlike it again? """
+
+        u2 = User(email="test2@test.com", username="testuser2", password="HASHED_PASSWORD")
+        msg = Message(text="Shared warble", user=u2)
+        db.session.add_all([u2, msg])
+        db.session.commit()
+        msg_id, u2_id = msg.id, u2.id
+
+        for user_id in (self.testuser.id, u2_id):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                resp = c.post(f"/messages/{msg_id}/like")
+                self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(Message.query.get(msg_id).likes_count, 2)
+
+        resp = c.post(f"/messages/{msg_id}/like")
+        self.assertEqual(Message.query.get(msg_id).likes_count, 1)
+        self.assertEqual(User.query.get(u2_id).likes_count, 0)
+
+        self.assertEqual(c.post("/messages/0/like").status_code, 404)
+
+
+    def test_user_follow_counts(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            u2 = User.signup("testuser2", "test2@test.com", "123456", "/static/images/default-pic.png")
+            db.session.commit()
+            c.post(f"/users/follow/{u2.id}")
+            c.post(f"/users/follow/{u2.id}")
+
+            self.assertEqual(User.query.get(self.testuser.id).following_count, 1)
+            self.assertEqual(User.query.get(u2.id).followers_count, 1)
+
+            c.post(f"/users/stop-following/{u2.id}")
+
+            self.assertEqual(User.query.get(self.testuser.id).following_count, 0)
+            self.assertEqual(User.query.get(u2.id).followers_count, 0)
+
+
+    def test_home_query_count(self):
+        """ Does the feed query count stay flat as the number of authors grows? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            ids = []
+            for i in range(5):
+                u = User(email=f"author{i}@test.com", username=f"author{i}", password="HASHED_PASSWORD")
+                db.session.add(u)
+                db.session.commit()
+                msg = Message(text=f"Warble {i}", user_id=u.id)
+                db.session.add(msg)
+                db.session.commit()
+                ids.append((u.id, msg.id))
+            for user_id, msg_id in ids:
+                c.post(f"/users/follow/{ user_id }")
+                c.post(f"/messages/{ msg_id }/like")
+
+            with assert_max_queries(4):
+                resp = c.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Warble 4", html)
+            self.assertEqual(html.count("btn-primary"), 5)
+
+            with assert_max_queries(2):
+                resp = c.get(f"/users/{self.testuser.id}/likes")
+            self.assertEqual(resp.status_code, 200)
+
+
+    def test_current_user_cached_in_session(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get("/messages/new")
+
+            with assert_max_queries(0):
+                resp = c.get("/messages/new")
+            self.assertIn('alt="testuser"', resp.get_data(as_text=True))
+
+
+    def test_profile_edit_refreshes_cached_user(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get("/messages/new")
+            resp = c.post("/users/profile", data={"username": "testuser",
+                                                  "email": "test@test.com",
+                                                  "image_url": "/static/images/new-pic.png",
+                                                  "password": "testuser"})
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.get("/messages/new")
+            self.assertIn('src="/static/images/new-pic.png"', resp.get_data(as_text=True))
+
+
+    def test_message_fragments_cached(self):
+        """Are feed rows rendered once, and again after a profile edit?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            id = self.testuser.id
+
+            msg = Message(text="Cached warble", user_id=id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_id = msg.id
+
+            c.get(f"/users/{id}")
+            version, html = fragments.cache.entries[msg_id]
+            self.assertIn("@testuser", html)
+
+            with mock.patch.object(fragments.cache, 'put') as put:
+                resp = c.get(f"/users/{id}")
+                self.assertFalse(put.called)
+            self.assertIn("Cached warble", resp.get_data(as_text=True))
+
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "test@test.com",
+                                           "password": "testuser"})
+            html = c.get(f"/users/{id}").get_data(as_text=True)
+            self.assertIn("@renamed", html)
+            self.assertNotIn("@testuser", html)
+
+
+    def test_users_search(self):
+        with self.client as c:
+            for name, bio, location in [("birdwatcher", "I love warblers", "Portland"),
+                                        ("catperson", "Meow", "Boston"),
+                                        ("nobody", "Likes birds a lot", "Portland")]:
+                db.session.add(User(email=f"{name}@test.com", username=name, bio=bio,
+                                    location=location, password="HASHED_PASSWORD"))
+            db.session.commit()
+
+            html = c.get("/users?q=bird").get_data(as_text=True)
+            self.assertIn("<p>@birdwatcher</p>", html)
+            self.assertIn("<p>@nobody</p>", html)
+            self.assertNotIn("<p>@catperson</p>", html)
+
+            html = c.get("/users?q=boston").get_data(as_text=True)
+            self.assertIn("<p>@catperson</p>", html)
+            self.assertNotIn("<p>@birdwatcher</p>", html)
+
+            html = c.get("/users?q=zzzzzz").get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
+
+    def test_users_search_pagination(self):
+        with self.client as c:
+            for i in range(3):
+                db.session.add(User(email=f"bird{i}@test.com", username=f"bird{i}",
+                                    password="HASHED_PASSWORD"))
+            db.session.commit()
+
+            with mock.patch('search.PER_PAGE', 2):
+                html = c.get("/users?q=bird").get_data(as_text=True)
+                self.assertEqual(html.count("<p>@bird"), 2)
+                self.assertIn("page=2", html)
+
+                html = c.get("/users?q=bird&page=2").get_data(as_text=True)
+                self.assertEqual(html.count("<p>@bird"), 1)
+                self.assertNotIn("page=3", html)
+
+
+    def test_users_search_skips_deactivated(self):
+        with self.client as c:
+            birds = [User(email=f"bird{i}@test.com", username=f"bird{i}",
+                          password="HASHED_PASSWORD") for i in range(4)]
+            db.session.add_all(birds)
+            db.session.commit()
+            c.get("/users?q=bird")
+
+            for u in birds[:2]:
+                deletions.request_deletion(u.id)
+            db.session.commit()
+
+            # full pages of the users still active
+            with mock.patch('search.PER_PAGE', 2):
+                html = c.get("/users?q=bird").get_data(as_text=True)
+                self.assertIn("<p>@bird2</p>", html)
+                self.assertIn("<p>@bird3</p>", html)
+                self.assertNotIn("page=2", html)
+
+
+    def test_users_directory_pagination(self):
+        with self.client as c:
+            for i in range(2):
+                db.session.add(User(email=f"u{i}@test.com", username=f"directory{i}",
+                                    password="HASHED_PASSWORD"))
+            db.session.commit()
+
+            with mock.patch('app.USERS_PER_PAGE', 2):
+                html = c.get("/users").get_data(as_text=True)
+                self.assertIn("<p>@testuser</p>", html)
+                self.assertIn("<p>@directory0</p>", html)
+                self.assertNotIn("<p>@directory1</p>", html)
+                self.assertIn("More users", html)
+
+                resp = c.get("/users?format=json")
+                data = resp.get_json()
+                self.assertEqual([u["username"] for u in data["users"]], ["testuser", "directory0"])
+                self.assertIn("format=json", data["next"])
+
+                data = c.get(data["next"]).get_json()
+                self.assertEqual([u["username"] for u in data["users"]], ["directory1"])
+                self.assertIsNone(data["next"])
+
+
+    def test_followers_pagination(self):
+        """ Are followers listed a page at a time in constant queries? """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            id = self.testuser.id
+
+            followers = []
+            for i in range(5):
+                u = User(email=f"fan{i}@test.com", username=f"fan{i}", bio=f"Fan bio {i}",
+                         password="HASHED_PASSWORD")
+                u.following.append(self.testuser)
+                followers.append(u)
+            db.session.add_all(followers)
+            db.session.commit()
+            self.testuser.following.append(followers[0])
+            db.session.commit()
+
+            with mock.patch('app.USERS_PER_PAGE', 3):
+                with assert_max_queries(4):
+                    resp = c.get(f"/users/{id}/followers")
+                html = resp.get_data(as_text=True)
+                self.assertIn("<p>@fan2</p>", html)
+                self.assertNotIn("<p>@fan3</p>", html)
+                self.assertIn("Fan bio 0", html)
+                self.assertEqual(html.count("Unfollow"), 1)
+
+                self.assertIn(f"/users/{id}/followers?after={followers[2].id}", html)
+                html = c.get(f"/users/{id}/followers?after={followers[2].id}").get_data(as_text=True)
+                self.assertIn("<p>@fan4</p>", html)
+                self.assertNotIn("<p>@fan2</p>", html)
+                self.assertNotIn("More users", html)
+
+                html = c.get(f"/users/{id}/following").get_data(as_text=True)
+                self.assertIn("<p>@fan0</p>", html)
+                self.assertNotIn("<p>@fan1</p>", html)
+
+
+    def test_profile_edit(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            id = self.testuser.id
+
+            resp = c.post("/users/profile", data={"username": "renamed",
+                                                  "email": "test@test.com",
+                                                  "bio": "New bio",
+                                                  "password": "wrongpass"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Incorrect password.", resp.get_data(as_text=True))
+
+            resp = c.post("/users/profile", data={"username": "renamed",
+                                                  "email": "test@test.com",
+                                                  "bio": "New bio",
+                                                  "password": "testuser"})
+            self.assertEqual(resp.status_code, 302)
+            u = User.query.get(id)
+            self.assertEqual((u.username, u.bio), ("renamed", "New bio"))
+
+            # confirmed recently, so no password (or bcrypt) this time
+            html = c.get("/users/profile").get_data(as_text=True)
+            self.assertNotIn("enter your password", html)
+            resp = c.post("/users/profile", data={"username": "renamed",
+                                                  "email": "test@test.com",
+                                                  "bio": "Newer bio"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(id).bio, "Newer bio")
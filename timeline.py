@@ -0,0 +1,212 @@
+"""Fan-out-on-write home timelines for Warbler.
+
+Every user has a materialized feed in the `timeline_entries` table. Posting
+a message copies a row into each follower's feed, following someone copies
+that user's recent messages in, and unfollowing or deleting removes rows, so
+reading the home feed never has to look at the follow graph.
+
+Authors with at least FANOUT_THRESHOLD followers ("celebrities") are the
+exception: writing one row per follower would stall their posts, so their
+messages are not pushed and are instead merged into the feed at read time.
+
+None of these functions commit; the calling route owns the transaction.
+"""
+
+import heapq
+import os
+from itertools import islice
+
+from models import db, Follows, Message, TimelineEntry, User
+import pagination
+
+# How many of a newly followed user's messages to copy into the feed.
+BACKFILL_LIMIT = 100
+
+# Authors with at least this many followers are pulled, not pushed.
+FANOUT_THRESHOLD = int(os.environ.get('TIMELINE_FANOUT_THRESHOLD', 10000))
+
+
+def is_celebrity(user_id):
+    """Are `user_id`'s messages pulled at read time instead of pushed?"""
+
+    followers = (db.session
+                 .query(User.followers_count)
+                 .filter(User.id == user_id)
+                 .scalar())
+
+    return (followers or 0) >= FANOUT_THRESHOLD
+
+
+def followed_celebrities(user_id):
+    """Ids of the celebrities `user_id` follows."""
+
+    rows = (_celebrities()
+            .join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == user_id)
+            .all())
+
+    return [celebrity_id for (celebrity_id,) in rows]
+
+
+def _celebrities():
+    """Query for the ids of every user at or over the fan-out threshold."""
+
+    return (db.session
+            .query(User.id)
+            .filter(User.followers_count >= FANOUT_THRESHOLD))
+
+
+def fan_out(message):
+    """Push `message` into the feed of everyone following its author.
+
+    The message must already be flushed so that it has an id. Celebrity
+    messages are skipped; feed() pulls them in. Returns the number of feeds
+    written to.
+    """
+
+    if is_celebrity(message.user_id):
+        return 0
+
+    followers = (db.select([Follows.user_following_id,
+                            db.literal(message.id),
+                            db.literal(message.user_id)])
+                 .where(Follows.user_being_followed_id == message.user_id))
+
+    result = db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id'], followers))
+
+    return result.rowcount
+
+
+def retract(message_ids):
+    """Remove a message (an id or a list of ids) from every feed it was
+    pushed to."""
+
+    if isinstance(message_ids, int):
+        criterion = TimelineEntry.message_id == message_ids
+    else:
+        criterion = TimelineEntry.message_id.in_(message_ids)
+
+    TimelineEntry.query.filter(criterion).delete(synchronize_session=False)
+
+
+def backfill(user_id, author_ids, limit=BACKFILL_LIMIT):
+    """Copy the most recent messages of `author_ids` (an id or a list of
+    ids) into `user_id`'s feed, up to `limit` from each.
+
+    One query finds which authors are celebrities, whose messages are
+    pulled at read time and not copied; one INSERT copies the rest.
+    """
+
+    if isinstance(author_ids, int):
+        author_ids = [author_ids]
+
+    celebrity_ids = {celebrity_id for (celebrity_id,) in
+                     _celebrities().filter(User.id.in_(author_ids))}
+    author_ids = [id for id in author_ids if id not in celebrity_ids]
+    if not author_ids:
+        return
+
+    # number each author's messages newest first, and keep the top `limit`
+    ranked = (db.select([Message.id,
+                         Message.user_id,
+                         db.func.row_number().over(
+                             partition_by=Message.user_id,
+                             order_by=Message.id.desc()).label('rank')])
+              .where(Message.user_id.in_(author_ids))
+              .alias('ranked'))
+
+    recent = (db.select([db.literal(user_id),
+                         ranked.c.id,
+                         ranked.c.user_id])
+              .where(ranked.c.rank <= limit))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id'], recent))
+
+
+def unfill(user_id, author_id):
+    """Remove every message by `author_id` from `user_id`'s feed."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id,
+             TimelineEntry.author_id == author_id)
+     .delete(synchronize_session=False))
+
+
+def feed(user_id, limit=100, before=None):
+    """Return the `limit` most recent messages in `user_id`'s feed.
+
+    `before` is an optional message id cursor from pagination.py; only
+    messages older than it are returned.
+
+    The pushed entries are merged with the recent messages of the
+    celebrities the user follows, fetched in one query however many there
+    are. A message can appear in both (its author crossed the threshold
+    after it was pushed), so merged ids are de-duped.
+    """
+
+    pushed = (pagination
+              .before_id(Message
+                         .query
+                         .options(db.joinedload(Message.user))
+                         .join(TimelineEntry,
+                               TimelineEntry.message_id == Message.id)
+                         .filter(TimelineEntry.user_id == user_id),
+                         TimelineEntry.message_id,
+                         before)
+              .limit(limit)
+              .all())
+
+    celebrity_ids = followed_celebrities(user_id)
+    if not celebrity_ids:
+        return pushed
+
+    pulled = (pagination
+              .before_id(Message
+                         .query
+                         .options(db.joinedload(Message.user))
+                         .filter(Message.user_id.in_(celebrity_ids)),
+                         Message.id,
+                         before)
+              .limit(limit)
+              .all())
+
+    merged = heapq.merge(pushed, pulled,
+                         key=lambda msg: msg.id,
+                         reverse=True)
+
+    seen = set()
+    unique = (msg for msg in merged
+              if not (msg.id in seen or seen.add(msg.id)))
+
+    return list(islice(unique, limit))
+
+
+def rebuild():
+    """Recompute every feed from the follows and messages tables.
+
+    Used after bulk-loading data (see seed.py) or to repair drift. Celebrity
+    messages are left out, as they are pulled at read time. Returns the
+    number of timeline rows written.
+    """
+
+    TimelineEntry.query.delete(synchronize_session=False)
+
+    entries = (db.select([Follows.user_following_id,
+                          Message.id,
+                          Message.user_id])
+               .select_from(Follows.__table__.join(
+                   Message.__table__,
+                   Message.user_id == Follows.user_being_followed_id))
+               .where(~Follows.user_being_followed_id.in_(
+                   _celebrities().subquery())))
+
+    result = db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'author_id'], entries))
+
+    return result.rowcount